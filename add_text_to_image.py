@@ -1,66 +1,183 @@
 # add_text_to_image.py
+#
+# リッチメニューの画像を、設定（RICH_MENU_VARIANTS）に書いた全種類について作成するスクリプト。
+# フォントとベース画像は一度だけ読み込んで使い回し、LINEの上限（1MB）に収まるように圧縮する。
+# 作成した画像とメニューの定義は、内容のハッシュと一緒にマニフェストに書き出し、
+# create_rich_menu.py はそれを見て、同じ内容のメニューがすでにあればアップロードを省略する。
 
 from PIL import Image, ImageDraw, ImageFont
-import os
+import hashlib
+import io
+import json
 
 # --- 設定項目 ---
 
 # 元になる画像ファイル名（文字なしの画像）
-BASE_IMAGE_PATH = "rich_menu_image.png" 
+BASE_IMAGE_PATH = "rich_menu_image.png"
 # プロジェクトフォルダにコピーしたフォントファイル名
 FONT_PATH = "NotoSansJP-Regular.ttf"
-# 追加したいテキスト
-TEXT_TO_ADD = "登録地点を変更する"
 # 文字のサイズ
 FONT_SIZE = 120
 # 文字の色 (R, G, B)
 TEXT_COLOR = (80, 80, 80)
-# 新しく保存する画像ファイル名
-OUTPUT_IMAGE_PATH = "rich_menu_with_text.png"
+# 作成した画像の保存先（{name}はメニューの種類の名前）と、マニフェストのファイル名
+OUTPUT_IMAGE_PATH = "rich_menu_{name}.png"
+MANIFEST_PATH = "rich_menu_manifest.json"
+# LINEのリッチメニュー画像の上限サイズ（バイト）
+RICH_MENU_MAX_BYTES = 1024 * 1024
+
+# 作成するリッチメニューの種類。areasの各ボタンの範囲(x, y, 幅, 高さ)は、ベース画像の幅・高さに対する割合で書き、
+# 範囲の中央下にlabelを描く。default=Trueのメニューが、create_rich_menu.pyで全ユーザーのデフォルトに設定される
+RICH_MENU_VARIANTS = [
+    {
+        "name": "location",
+        "chat_bar_text": "メニュー",
+        "default": True,
+        "areas": [
+            {"label": "登録地点を変更する", "bounds": (0, 0, 1, 1),
+             "action": {"type": "postback", "label": "change_location", "data": "action=change_location"}},
+        ],
+    },
+    {
+        "name": "location-and-time",
+        "chat_bar_text": "メニュー",
+        "areas": [
+            {"label": "地点を変更", "bounds": (0, 0, 0.5, 1),
+             "action": {"type": "postback", "label": "change_location", "data": "action=change_location"}},
+            {"label": "通知時刻", "bounds": (0.5, 0, 0.5, 1),
+             "action": {"type": "message", "label": "通知時刻", "text": "通知時刻"}},
+        ],
+    },
+]
 
 # --- ここから処理 ---
 
-def add_text_to_image():
-    # 1. ベース画像を開く
+_fonts = {} # (フォントファイル, サイズ) -> フォント
+
+def load_font(size=FONT_SIZE, path=FONT_PATH):
+    """フォントを読み込む関数（同じファイル・サイズは一度だけ読み込む）"""
+    key = (path, size)
+    if key not in _fonts:
+        _fonts[key] = ImageFont.truetype(path, size)
+        print(f"フォント '{path}' (サイズ {size}) を読み込みました。")
+    return _fonts[key]
+
+def area_bounds(bounds, size):
+    """割合で書いたボタンの範囲を、画像上のピクセル(x, y, 幅, 高さ)に変換する関数"""
+    (left, top, width, height), (img_width, img_height) = bounds, size
+    x, y = round(left * img_width), round(top * img_height)
+    # 右端・下端から幅・高さを求め、隣り合うボタンとの間に隙間や重なりができないようにする
+    return x, y, round((left + width) * img_width) - x, round((top + height) * img_height) - y
+
+def validate_variant(variant, size, font):
+    """ボタンの範囲が画像に収まり、ラベルがボタンの幅に収まることを確認する関数（収まらなければValueError）"""
+    img_width, img_height = size
+    for area in variant["areas"]:
+        x, y, width, height = area_bounds(area["bounds"], size)
+        if width <= 0 or height <= 0 or x < 0 or y < 0 or x + width > img_width or y + height > img_height:
+            raise ValueError(f"「{variant['name']}」のボタン「{area['label']}」の範囲 {(x, y, width, height)} が、"
+                             f"画像 {img_width}x{img_height} からはみ出しています。")
+        text_bbox = font.getbbox(area["label"])
+        if text_bbox[2] - text_bbox[0] > width:
+            raise ValueError(f"「{variant['name']}」のボタン「{area['label']}」のラベルが、ボタンの幅 {width}px に収まりません。")
+
+def render_variant(base_image, variant, font):
+    """ベース画像のコピーに、各ボタンのラベルを描画した画像を返す関数"""
+    img = base_image.copy()
+    draw = ImageDraw.Draw(img)
+    for area in variant["areas"]:
+        x, y, width, height = area_bounds(area["bounds"], img.size)
+        # テキスト自体の幅を取得し、ボタンの範囲の中央より少し下に配置する
+        text_bbox = draw.textbbox((0, 0), area["label"], font=font)
+        text_width = text_bbox[2] - text_bbox[0]
+        position = (x + (width - text_width) / 2, y + height / 2 + 150)
+        draw.text(position, area["label"], font=font, fill=TEXT_COLOR)
+    return img
+
+def encode_png(img, max_bytes=RICH_MENU_MAX_BYTES):
+    """画像をPNGのbytesにする関数。上限を超える場合は256色に減色してから圧縮する"""
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG", optimize=True)
+    data = buffer.getvalue()
+    if len(data) <= max_bytes:
+        return data
+    print(f"PNGが{len(data) / 1024:.0f}KBで上限を超えたため、256色に減色します。")
+    method = Image.Quantize.FASTOCTREE if img.mode == "RGBA" else Image.Quantize.MEDIANCUT
+    buffer = io.BytesIO()
+    img.quantize(colors=256, method=method).save(buffer, format="PNG", optimize=True)
+    data = buffer.getvalue()
+    if len(data) > max_bytes:
+        raise ValueError(f"減色しても{len(data) / 1024:.0f}KBあり、上限の{max_bytes // 1024}KBに収まりません。")
+    return data
+
+def menu_definition(variant, size):
+    """設定から、リッチメニュー作成APIに渡す定義（nameを除く）を作る関数"""
+    return {
+        "size": {"width": size[0], "height": size[1]},
+        "selected": False,
+        "chatBarText": variant["chat_bar_text"],
+        "areas": [
+            {"bounds": dict(zip(("x", "y", "width", "height"), area_bounds(area["bounds"], size))), "action": area["action"]}
+            for area in variant["areas"]
+        ],
+    }
+
+def content_hash(image_data, definition):
+    """画像とメニューの定義の両方から、内容のハッシュを求める関数"""
+    digest = hashlib.sha256(image_data)
+    digest.update(json.dumps(definition, ensure_ascii=False, sort_keys=True, separators=(",", ":")).encode("utf-8"))
+    return digest.hexdigest()
+
+def build_rich_menu_assets(variants=RICH_MENU_VARIANTS):
+    """全種類のリッチメニュー画像を作成し、マニフェストを書き出す関数"""
+    # 1. ベース画像とフォントは一度だけ読み込む
     try:
-        img = Image.open(BASE_IMAGE_PATH)
+        with Image.open(BASE_IMAGE_PATH) as f:
+            base_image = f.copy()
         print(f"画像 '{BASE_IMAGE_PATH}' を開きました。")
     except FileNotFoundError:
         print(f"エラー: ベース画像 '{BASE_IMAGE_PATH}' が見つかりません。")
         print("文字なしの背景画像を、この名前でプロジェクトフォルダに保存してください。")
-        return
-
-    # 2. 描画オブジェクトとフォントオブジェクトを作成
-    draw = ImageDraw.Draw(img)
+        return None
     try:
-        font = ImageFont.truetype(FONT_PATH, FONT_SIZE)
-        print(f"フォント '{FONT_PATH}' を読み込みました。")
+        font = load_font()
     except IOError:
         print(f"エラー: フォントファイル '{FONT_PATH}' が見つかりません。")
         print("ステップ2を参考に、正しいフォントファイルをプロジェクトフォルダに置いてください。")
-        return
-
-    # 画像の中央下に配置する
-    img_width, img_height = img.size
-    # テキスト自体の幅と高さを取得
-    text_bbox = draw.textbbox((0, 0), TEXT_TO_ADD, font=font)
-    text_width = text_bbox[2] - text_bbox[0]
-    text_height = text_bbox[3] - text_bbox[1]
-    
-    # 中央に配置するためのx, y座標を計算
-    position_x = (img_width - text_width) / 2
-    # y座標は、画像の中央より少し下あたりに設定
-    position_y = (img_height / 2) + 150 
-    
-    position = (position_x, position_y)
-
-    # 4. 画像にテキストを描画
-    draw.text(position, TEXT_TO_ADD, font=font, fill=TEXT_COLOR)
-    print(f"テキスト '{TEXT_TO_ADD}' を描画しました。")
-
-    # 5. 新しい画像として保存
-    img.save(OUTPUT_IMAGE_PATH)
-    print(f"完成した画像を '{OUTPUT_IMAGE_PATH}'として保存しました。")
+        return None
+
+    # 2. 画像やマニフェストを書き出す前に、全種類のボタンの配置を確認する
+    try:
+        for variant in variants:
+            validate_variant(variant, base_image.size, font)
+    except ValueError as e:
+        print(f"エラー: {e}")
+        return None
+
+    # 3. 種類ごとに描画・圧縮し、ハッシュを求めて保存する
+    manifest = []
+    for variant in variants:
+        data = encode_png(render_variant(base_image, variant, font))
+        definition = menu_definition(variant, base_image.size)
+        digest = content_hash(data, definition)
+        path = OUTPUT_IMAGE_PATH.format(name=variant["name"])
+        with open(path, "wb") as f:
+            f.write(data)
+        manifest.append({
+            "name": variant["name"],
+            "default": variant.get("default", False),
+            "image_path": path,
+            "image_bytes": len(data),
+            "sha256": digest,
+            "menu": definition,
+        })
+        print(f"'{path}' を保存しました。({len(data) / 1024:.0f}KB, sha256 {digest[:16]})")
+
+    # 4. create_rich_menu.pyが読むマニフェストを書き出す
+    with open(MANIFEST_PATH, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    print(f"マニフェストを '{MANIFEST_PATH}' に保存しました。({len(manifest)}種類)")
+    return manifest
 
 if __name__ == "__main__":
-    add_text_to_image()
\ No newline at end of file
+    build_rich_menu_assets()
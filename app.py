@@ -1,85 +1,244 @@
 import os
+import re
+import atexit
+import threading
+import time
 import requests
 import json
-from flask import Flask, request, abort
+import unicodedata
+from collections import namedtuple
+from flask import Flask, request, abort, jsonify, Response
 from linebot.v3 import WebhookHandler
 from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.webhooks import MessageEvent, TextMessageContent, FollowEvent, PostbackEvent
-# QuickReply機能に必要な部品をインポート
-from linebot.v3.messaging import (
-    Configuration, ApiClient, MessagingApi, ReplyMessageRequest, TextMessage,
-    QuickReply, QuickReplyButton, MessageAction
-)
-from datetime import datetime
 from dotenv import load_dotenv
 import database
-import xml.etree.ElementTree as ET
+import metrics
+import http_client
+import area_data
+import quick_replies
+from flex_template import messages_json, reply_body
+from event_queue import EventWorkerPool
 
 # --- 初期設定 ---
+STARTED_AT = time.perf_counter()
 load_dotenv()
 app = Flask(__name__)
 
-with app.app_context():
-    database.init_db()
-
 CHANNEL_ACCESS_TOKEN = os.environ.get("LINE_CHANNEL_ACCESS_TOKEN")
 CHANNEL_SECRET = os.environ.get("LINE_CHANNEL_SECRET")
+# 接続先（負荷試験ではローカルの代替サーバーに向ける）
+LINE_API_BASE_URL = os.environ.get("LINE_API_BASE_URL", "https://api.line.me")
+WEATHER_API_BASE_URL = os.environ.get("WEATHER_API_BASE_URL", "https://weather.tsukumijima.net")
 
 handler = WebhookHandler(CHANNEL_SECRET)
 
+# WEBHOOK_ASYNC=1 のとき、/callbackは署名検証後すぐに応答し、イベントはワーカーで処理する
+WEBHOOK_ASYNC = os.environ.get("WEBHOOK_ASYNC", "0") == "1"
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", "4"))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_DRAIN_TIMEOUT = float(os.environ.get("WEBHOOK_DRAIN_TIMEOUT", "25"))
+
+# バックグラウンドで上流から地域・都市リストを取り直す間隔（秒）。0なら起動時の1回だけ
+AREA_REFRESH_INTERVAL = int(os.environ.get("AREA_REFRESH_INTERVAL", "86400"))
+# 起動時の準備（DB初期化・地域情報の取得）に失敗したときの再試行間隔の上限（秒）。間隔は1秒から倍々に延ばす
+WARM_UP_RETRY_MAX = float(os.environ.get("WARM_UP_RETRY_MAX", "60"))
+
 # --- グローバル変数 ---
 AREA_DATA_CACHE = None
+# ウィザードの各ステップ・各ページのQuickReply付きメッセージ（AREA_DATA_CACHEから作る）
+QUICK_REPLY_CACHE = None
+AREA_DATA_LOCK = threading.Lock()
+# 起動準備（DB初期化・地域情報の読み込み）の状況。/readyで返す
+READINESS = {"database": False, "area_data": False, "area_source": None, "area_version": None, "ready_after_seconds": None}
 
 # --- 補助関数群 ---
-def get_area_data():
-    """livedoor互換APIの都市リストXMLを取得・キャッシュする関数"""
-    global AREA_DATA_CACHE
-    if AREA_DATA_CACHE is not None:
-        return AREA_DATA_CACHE
+def _set_area_data(index, source):
+    global AREA_DATA_CACHE, QUICK_REPLY_CACHE
+    QUICK_REPLY_CACHE = quick_replies.build_quick_reply_cache(index)
+    AREA_DATA_CACHE = index
+    READINESS.update(area_data=True, area_source=source, area_version=index.version)
+
+def refresh_area_data():
+    """上流から地域・都市リストを取り直し、内容が変わっていればキャッシュとスナップショットを更新する関数"""
+    source = f"{WEATHER_API_BASE_URL}/primary_area.xml"
     try:
-        response = requests.get("https://weather.tsukumijima.net/primary_area.xml")
-        response.raise_for_status()
-        try:
-            AREA_DATA_CACHE = ET.fromstring(response.content.decode('euc-jp'))
-        except Exception:
-            AREA_DATA_CACHE = ET.fromstring(response.content.decode('utf-8'))
-        print("地域・都市リストをダウンロード・キャッシュしました。")
-        return AREA_DATA_CACHE
+        areas = area_data.fetch_areas(source)
     except Exception as e:
         print(f"地域・都市リストの取得に失敗しました: {e}")
         return None
+    index = area_data.build_area_index(areas)
+    if AREA_DATA_CACHE is None or AREA_DATA_CACHE.version != index.version:
+        _set_area_data(index, "upstream")
+        try:
+            area_data.save_snapshot(areas, source)
+        except OSError as e:
+            print(f"地域・都市リストのスナップショットを保存できませんでした: {e}")
+        print(f"地域・都市リストをダウンロード・キャッシュしました。(version {index.version})")
+    return index
 
-def create_quick_reply(options):
-    """選択肢のリストからQuickReplyボタンを作成する関数"""
-    if len(options) > 13:
-        options = options[:13] # LINEのQuickReplyは最大13個
-    items = [QuickReplyButton(action=MessageAction(label=opt, text=opt)) for opt in options]
-    return QuickReply(items=items)
+def get_area_data():
+    """地域・都市リストのAreaIndexを返す関数。まだ読み込まれていなければ上流から取得する"""
+    if AREA_DATA_CACHE is not None:
+        return AREA_DATA_CACHE
+    # 同時に来たリクエストがそれぞれ上流に取りに行かないよう、取得は1つだけにする
+    with AREA_DATA_LOCK:
+        if AREA_DATA_CACHE is None:
+            refresh_area_data()
+    return AREA_DATA_CACHE
+
+def _mark_ready_if_done():
+    if READINESS["database"] and READINESS["area_data"] and READINESS["ready_after_seconds"] is None:
+        READINESS["ready_after_seconds"] = round(time.perf_counter() - STARTED_AT, 3)
+        print(f"起動準備が完了しました。({READINESS['ready_after_seconds']}秒)")
+
+def warm_up():
+    """起動時の準備をする関数。スナップショットを読み込み、DB初期化と上流からの更新はバックグラウンドで行う"""
+    snapshot = area_data.load_snapshot()
+    if snapshot is not None:
+        index, fetched_at = snapshot
+        _set_area_data(index, "snapshot")
+        print(f"地域・都市リストをスナップショットから読み込みました。(version {index.version}, {int(time.time() - fetched_at)}秒前に取得)")
+
+    def background():
+        # DBがまだ起動していない・他のプロセスとマイグレーションが競合したなどの場合は、待ってからやり直す
+        delay = 1.0
+        while True:
+            try:
+                with app.app_context():
+                    database.init_db()
+                break
+            except Exception as e:
+                print(f"データベースの初期化に失敗しました。{delay:.0f}秒後に再試行します: {e}")
+                time.sleep(delay)
+                delay = min(delay * 2, WARM_UP_RETRY_MAX)
+        READINESS["database"] = True
+        _mark_ready_if_done()
+
+        delay = 1.0
+        while True:
+            try:
+                with AREA_DATA_LOCK:
+                    refresh_area_data()
+            except Exception as e:
+                print(f"地域・都市リストの更新中にエラーが発生しました: {e}")
+            _mark_ready_if_done()
+            if AREA_REFRESH_INTERVAL <= 0:
+                return
+            if READINESS["area_data"]:
+                delay = 1.0
+                time.sleep(AREA_REFRESH_INTERVAL)
+            else:
+                # まだ一度も読み込めていなければ、更新間隔を待たずに再試行する
+                time.sleep(delay)
+                delay = min(delay * 2, WARM_UP_RETRY_MAX, AREA_REFRESH_INTERVAL)
 
-def reply_to_line(reply_token, text, quick_reply=None):
-    """LINEにメッセージを返信する関数"""
+    threading.Thread(target=background, name="warm-up", daemon=True).start()
+
+def _send_reply(reply_token, messages):
+    """シリアライズ済みのメッセージ配列(bytes)をLINEに返信する関数"""
     headers = {"Content-Type": "application/json; charset=UTF-8", "Authorization": f"Bearer {CHANNEL_ACCESS_TOKEN}"}
-    message_payload = {"type": "text", "text": text}
-    if quick_reply:
-        message_payload["quickReply"] = quick_reply.to_dict()
-    body = {"replyToken": reply_token, "messages": [message_payload]}
     try:
-        response = requests.post("https://api.line.me/v2/bot/message/reply", headers=headers, data=json.dumps(body, ensure_ascii=False).encode('utf-8'))
+        response = http_client.post(f"{LINE_API_BASE_URL}/v2/bot/message/reply", endpoint="line_reply", headers=headers, data=reply_body(reply_token, messages))
         response.raise_for_status()
         print("LINEへの返信が成功しました。")
     except requests.exceptions.RequestException as e:
         print(f"LINE返信エラー: {e}\n応答内容: {e.response.text if e.response else 'N/A'}")
 
+def reply_to_line(reply_token, text):
+    """LINEにテキストメッセージを返信する関数"""
+    _send_reply(reply_token, json.dumps([{"type": "text", "text": text}], ensure_ascii=False).encode('utf-8'))
+
+def reply_with_choices(reply_token, node, page=1):
+    """ウィザードの選択肢（QuickReply）付きメッセージを、作成済みのキャッシュから返信する関数
+
+    nodeの選択肢がない（地域情報の更新で名前が変わったなど）場合は、エリアの選択肢を返す。
+    """
+    pages = QUICK_REPLY_CACHE.get(node)
+    if pages is None:
+        pages = QUICK_REPLY_CACHE[("area", None)]
+    page = min(max(page, 1), len(pages))
+    _send_reply(reply_token, messages_json(pages[page - 1]))
+
+class _ParsedPayloadParser:
+    """解析済みのWebhookの内容をそのまま返すパーサー
+
+    非同期処理では受信時に署名を検証・解析しておき、ワーカーからは解析済みの内容で
+    handler.handle を呼ぶ。振り分け（デフォルトハンドラーやdestinationの受け渡しを含む）はSDKに任せる。
+    """
+
+    def parse(self, body, signature, as_payload=False):
+        return body
+
+# キューに入れる、イベント1件分のWebhookの内容（handler.handleはdestinationとeventsだけを使う）
+SingleEventPayload = namedtuple("SingleEventPayload", ["destination", "events"])
+
+def dispatch_event(payload):
+    """解析済みのWebhookの内容(SingleEventPayload)を、handler.addで登録した関数に振り分ける関数"""
+    handler.handle(payload, None)
+
+EVENT_POOL = None
+if WEBHOOK_ASYNC:
+    # 受信時の署名検証には元のパーサーを使い、handler自体は解析済みの内容を受け取るようにする
+    webhook_parser = handler.parser
+    handler.parser = _ParsedPayloadParser()
+    EVENT_POOL = EventWorkerPool(dispatch_event, workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE)
+    # プロセス終了時は、受け付け済みのイベントを処理し終えてから止める
+    atexit.register(EVENT_POOL.drain, WEBHOOK_DRAIN_TIMEOUT)
+
 @app.route("/callback", methods=['POST'])
 def callback():
     signature = request.headers['X-Line-Signature']
     body = request.get_data(as_text=True)
+    if EVENT_POOL is None:
+        try:
+            handler.handle(body, signature)
+        except InvalidSignatureError:
+            abort(400)
+        # 計測用のイベント種別は、署名検証を通った本文から数える
+        for event in json.loads(body).get("events", []):
+            metrics.inc("webhook_events_total", type=event.get("type", "unknown"))
+        return 'OK'
+
     try:
-        handler.handle(body, signature)
+        payload = webhook_parser.parse(body, signature, as_payload=True)
     except InvalidSignatureError:
         abort(400)
+    for event in payload.events:
+        metrics.inc("webhook_events_total", type=event.type)
+        user_id = getattr(event.source, 'user_id', None)
+        # イベントごとに、destinationを保ったまま1件だけの内容にしてキューに入れる
+        single = SingleEventPayload(payload.destination, [event])
+        if not EVENT_POOL.enqueue(user_id, single):
+            # その場で処理すると、キューで待っている同じユーザーのイベントを追い越してしまうので破棄する
+            metrics.inc("webhook_events_dropped_total", type=event.type)
+            print(f"Webhookキューが一杯のため、イベントを破棄しました。(ユーザー: {user_id})")
     return 'OK'
 
+@app.route("/metrics", methods=['GET'])
+def metrics_endpoint():
+    """計測値をPrometheus形式で返す"""
+    if EVENT_POOL is not None:
+        for key, value in EVENT_POOL.stats().items():
+            metrics.set_gauge(f"webhook_queue_{key}", value)
+    for origin, stats in http_client.stats().items():
+        metrics.set_gauge("http_client_requests", stats["requests"], host=origin)
+        metrics.set_gauge("http_client_connections", stats["connections"], host=origin)
+    return Response(metrics.render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/ready", methods=['GET'])
+def ready():
+    """起動準備が完了していれば200、まだなら503を返す（ロードバランサーのヘルスチェック用）"""
+    is_ready = READINESS["database"] and READINESS["area_data"]
+    return jsonify({"ready": is_ready, **READINESS}), 200 if is_ready else 503
+
+@app.route("/webhook/stats", methods=['GET'])
+def webhook_stats():
+    """非同期処理キューの滞留状況を返す"""
+    if EVENT_POOL is None:
+        return jsonify({"async": False})
+    return jsonify({"async": True, **EVENT_POOL.stats()})
+
 def start_location_setting(event):
     """地点登録/変更のフローを開始する関数"""
     user_id = event.source.user_id
@@ -88,9 +247,7 @@ def start_location_setting(event):
     if not area_data:
         reply_to_line(event.reply_token, "地域情報の取得に失敗しました。しばらくしてからお試しください。")
         return
-    area_names = [area.get('title') for area in area_data.findall('.//area')]
-    quick_reply = create_quick_reply(area_names)
-    reply_to_line(event.reply_token, "お住まいのエリアを選択してください。", quick_reply)
+    reply_with_choices(event.reply_token, ("area", None))
 
 # --- イベントごとの処理 ---
 @handler.add(FollowEvent)
@@ -102,49 +259,97 @@ def handle_postback(event):
     if event.postback.data == 'action=change_location':
         start_location_setting(event)
 
+def _state_branch(user_state):
+    """計測用に、ユーザーの状態を対話のステップ名にする関数"""
+    if not user_state:
+        return 'none'
+    return user_state.split(':')[0]
+
+# 「通知時刻 7:30」のように送ると通知時刻を変更できる（時刻を省略すると現在の設定を返す）
+DELIVERY_TIME_COMMAND = re.compile(r"^通知時刻\s*(?:(\d{1,2}):(\d{2}))?$")
+
+def handle_delivery_time_command(event, user_message):
+    """通知時刻の確認・変更コマンドなら処理してTrueを、そうでなければFalseを返す関数"""
+    # 全角の数字・コロンも受け付ける
+    match = DELIVERY_TIME_COMMAND.match(unicodedata.normalize("NFKC", user_message).strip())
+    if not match:
+        return False
+    user_id = event.source.user_id
+    if match.group(1) is None:
+        minute = database.get_user_delivery_minute(user_id)
+        if minute is None:
+            minute = database.default_delivery_minute(user_id)
+        reply_to_line(event.reply_token, f"現在の通知時刻は {minute // 60}:{minute % 60:02d} です。\n"
+                                         "変更するには「通知時刻 7:30」のように送ってください。")
+        return True
+    hour, minute = int(match.group(1)), int(match.group(2))
+    if hour > 23 or minute > 59:
+        reply_to_line(event.reply_token, "通知時刻は 0:00〜23:59 の範囲で指定してください。")
+        return True
+    database.set_user_delivery_minute(user_id, hour * 60 + minute)
+    reply_to_line(event.reply_token, f"通知時刻を {hour}:{minute:02d} に設定しました。")
+    return True
+
+def _wizard_node(user_state):
+    """ウィザードの状態から、QuickReplyキャッシュのキーを求める関数（ウィザード中でなければNone）"""
+    if user_state == 'waiting_for_area':
+        return ("area", None)
+    if user_state and user_state.startswith('waiting_for_pref:'):
+        return ("pref", user_state.split(':')[1])
+    if user_state and user_state.startswith('waiting_for_city:'):
+        return ("city", user_state.split(':')[1])
+    return None
+
 @handler.add(MessageEvent, message=TextMessageContent)
 def handle_message(event):
     user_id = event.source.user_id
     user_message = event.message.text
     user_state = database.get_user_state(user_id)
-    
-    area_data = get_area_data()
-    if not area_data:
-        reply_to_line(event.reply_token, "地域情報の取得に失敗しました。")
-        return
+    with metrics.timer("webhook_message_duration_seconds", branch=_state_branch(user_state)):
+        if handle_delivery_time_command(event, user_message):
+            return
+        area_data = get_area_data()
+        if not area_data:
+            reply_to_line(event.reply_token, "地域情報の取得に失敗しました。")
+            return
 
-    if user_state == 'waiting_for_area':
-        selected_area = area_data.find(f".//area[@title='{user_message}']")
-        if selected_area:
-            pref_names = [pref.get('title') for pref in selected_area.findall('pref')]
-            quick_reply = create_quick_reply(pref_names)
-            database.set_user_state(user_id, f'waiting_for_pref:{user_message}')
-            reply_to_line(event.reply_token, "次に都道府県を選択してください。", quick_reply)
-        else:
-            reply_to_line(event.reply_token, "ボタンから正しいエリア名を選択してください。")
-    elif user_state and user_state.startswith('waiting_for_pref:'):
-        area_name = user_state.split(':')[1]
-        selected_area = area_data.find(f".//area[@title='{area_name}']")
-        selected_pref = selected_area.find(f".//pref[@title='{user_message}']") if selected_area else None
-        if selected_pref:
-            city_names = [city.get('title') for city in selected_pref.findall('city')]
-            quick_reply = create_quick_reply(city_names)
-            database.set_user_state(user_id, f'waiting_for_city:{user_message}')
-            reply_to_line(event.reply_token, "最後に都市名を選択してください。", quick_reply)
+        node = _wizard_node(user_state)
+        page = quick_replies.requested_page(user_message)
+        if node is not None and node not in QUICK_REPLY_CACHE:
+            # 保存された状態のエリア・都道府県が今の地域情報にない（更新で名前が変わった・古い状態など）ので、
+            # エリアの選択からやり直してもらう
+            database.set_user_state(user_id, 'waiting_for_area')
+            reply_with_choices(event.reply_token, ("area", None))
+        elif node is not None and page is not None:
+            # 「前へ／次へ」ボタン。状態はそのままで、選択肢の別のページを返す
+            reply_with_choices(event.reply_token, node, page)
+        elif user_state == 'waiting_for_area':
+            if user_message in area_data.prefs_by_area:
+                database.set_user_state(user_id, f'waiting_for_pref:{user_message}')
+                reply_with_choices(event.reply_token, ("pref", user_message))
+            else:
+                reply_to_line(event.reply_token, "ボタンから正しいエリア名を選択してください。")
+        elif user_state and user_state.startswith('waiting_for_pref:'):
+            area_name = user_state.split(':')[1]
+            if user_message in area_data.prefs_by_area.get(area_name, ()) and user_message in area_data.cities_by_pref:
+                database.set_user_state(user_id, f'waiting_for_city:{user_message}')
+                reply_with_choices(event.reply_token, ("city", user_message))
+            else:
+                reply_to_line(event.reply_token, "ボタンから正しい都道府県名を選択してください。")
+        elif user_state and user_state.startswith('waiting_for_city:'):
+            pref_name = user_state.split(':')[1]
+            city_id = area_data.city_ids_by_pref.get(pref_name, {}).get(user_message)
+            if city_id is not None:
+                city_name = user_message
+                database.set_user_location(user_id, city_name, city_id)
+                reply_to_line(event.reply_token, f"地点を「{city_name}」に設定しました！\n明日から毎朝、天気予報をお届けします。")
+            else:
+                reply_to_line(event.reply_token, "ボタンから正しい都市名を選択してください。")
         else:
-            reply_to_line(event.reply_token, "ボタンから正しい都道府県名を選択してください。")
-    elif user_state and user_state.startswith('waiting_for_city:'):
-        pref_name = user_state.split(':')[1]
-        selected_city_element = area_data.find(f".//pref[@title='{pref_name}']/city[@title='{user_message}']")
-        if selected_city_element is not None:
-            city_id = selected_city_element.get('id')
-            city_name = selected_city_element.get('title')
-            database.set_user_location(user_id, city_name, city_id)
-            reply_to_line(event.reply_token, f"地点を「{city_name}」に設定しました！\n明日から毎朝、天気予報をお届けします。")
-        else:
-            reply_to_line(event.reply_token, "ボタンから正しい都市名を選択してください。")
-    else:
-        reply_to_line(event.reply_token, "メニューの「地点を変更する」から、通知先を設定してください。")
+            reply_to_line(event.reply_token, "メニューの「地点を変更する」から、通知先を設定してください。\n"
+                                             "「通知時刻 7:30」のように送ると、通知時刻を変更できます。")
+
+warm_up()
 
 if __name__ == "__main__":
     app.run(port=5000)
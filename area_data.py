@@ -0,0 +1,126 @@
+# area_data.py
+#
+# 地点登録で使う「エリア → 都道府県 → 都市」の一覧（primary_area.xml）を扱うモジュール。
+# アプリは起動時にディスク上のスナップショットを読み込み、上流からの取得はバックグラウンドで行う。
+#
+# スナップショットを作成・更新するには:
+#   python area_data.py
+# デプロイ時のビルドでも実行し、新しいインスタンスが上流に繋がらなくても起動できるようにする。
+# 作成したarea_snapshot.jsonはリポジトリにコミットしておき、ビルド時に上流が落ちていればそれを使う。
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+from collections import namedtuple
+from types import MappingProxyType
+
+import http_client
+
+# スナップショットの形式のバージョン（形式を変えたら上げる）
+SNAPSHOT_FORMAT_VERSION = 1
+AREA_SNAPSHOT_PATH = os.environ.get(
+    "AREA_SNAPSHOT_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "area_snapshot.json"))
+
+# 地域・都道府県・都市の階層を辞書で引けるようにした索引（変更不可）
+AreaIndex = namedtuple("AreaIndex", [
+    "area_names",       # (エリア名, ...)
+    "prefs_by_area",    # エリア名 -> (都道府県名, ...)
+    "cities_by_pref",   # 都道府県名 -> (都市名, ...)
+    "city_ids_by_pref", # 都道府県名 -> {都市名: 都市ID}
+    "version",          # 内容のハッシュ（内容が変わったかどうかの判定に使う）
+])
+
+def content_hash(areas):
+    """エリア一覧の内容から、バージョンとして使う短いハッシュを作る関数"""
+    serialized = json.dumps(areas, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()[:16]
+
+def build_area_index(areas):
+    """[[エリア名, [[都道府県名, [[都市名, 都市ID], ...]], ...]], ...] からAreaIndexを作る関数"""
+    area_names, prefs_by_area, cities_by_pref, city_ids_by_pref = [], {}, {}, {}
+    for area_name, prefs in areas:
+        area_names.append(area_name)
+        for pref_name, cities in prefs:
+            cities_by_pref[pref_name] = tuple(name for name, _ in cities)
+            city_ids_by_pref[pref_name] = MappingProxyType({name: city_id for name, city_id in cities})
+        prefs_by_area[area_name] = tuple(pref_name for pref_name, _ in prefs)
+    return AreaIndex(
+        area_names=tuple(area_names),
+        prefs_by_area=MappingProxyType(prefs_by_area),
+        cities_by_pref=MappingProxyType(cities_by_pref),
+        city_ids_by_pref=MappingProxyType(city_ids_by_pref),
+        version=content_hash(areas),
+    )
+
+def parse_area_xml(content):
+    """primary_area.xmlを一度だけ走査して、エリア一覧に変換する関数"""
+    import xml.etree.ElementTree as ET # 起動時には使わないので、必要になってから読み込む
+    try:
+        root = ET.fromstring(content.decode('euc-jp'))
+    except Exception:
+        root = ET.fromstring(content.decode('utf-8'))
+    return [
+        [area.get('title'), [
+            [pref.get('title'), [[city.get('title'), city.get('id')] for city in pref.findall('city')]]
+            for pref in area.findall('pref')
+        ]]
+        for area in root.iter('area')
+    ]
+
+def fetch_areas(url):
+    """上流からprimary_area.xmlを取得して、エリア一覧を返す関数"""
+    response = http_client.get(url, endpoint="weather_area")
+    response.raise_for_status()
+    return parse_area_xml(response.content)
+
+def load_snapshot(path=AREA_SNAPSHOT_PATH):
+    """スナップショットを読み込み、(AreaIndex, 取得時刻のUNIX時間) を返す関数。使えない場合はNone"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print(f"地域・都市リストのスナップショットを読み込めませんでした: {e}")
+        return None
+    if snapshot.get("format_version") != SNAPSHOT_FORMAT_VERSION:
+        print(f"地域・都市リストのスナップショットの形式が異なるため使用しません: {snapshot.get('format_version')}")
+        return None
+    return build_area_index(snapshot["areas"]), snapshot.get("fetched_at", 0)
+
+def save_snapshot(areas, source, path=AREA_SNAPSHOT_PATH):
+    """エリア一覧をスナップショットとして保存する関数（一時ファイルに書いてから置き換える）"""
+    snapshot = {
+        "format_version": SNAPSHOT_FORMAT_VERSION,
+        "version": content_hash(areas),
+        "source": source,
+        "fetched_at": time.time(),
+        "areas": areas,
+    }
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".area_snapshot.", suffix=".json")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return snapshot["version"]
+
+if __name__ == "__main__":
+    base_url = os.environ.get("WEATHER_API_BASE_URL", "https://weather.tsukumijima.net")
+    source = f"{base_url}/primary_area.xml"
+    try:
+        areas = fetch_areas(source)
+    except Exception as e:
+        # ビルド時に上流が落ちていても、コミット済みのスナップショットがあればそれでデプロイを続ける
+        existing = load_snapshot()
+        if existing is None:
+            raise
+        print(f"地域・都市リストの取得に失敗したため、既存のスナップショットを使います (version {existing[0].version}): {e}")
+        raise SystemExit(0)
+    version = save_snapshot(areas, source)
+    print(f"地域・都市リストのスナップショットを保存しました: {AREA_SNAPSHOT_PATH} (version {version}, {len(areas)}エリア)")
@@ -0,0 +1,71 @@
+# benchmarks/bench_flex_template.py
+#
+# 毎朝の通知1件あたりのCPUコストを、従来の方式（宛先ごとにFlex Messageのdictを組み立てて
+# json.dumpsする）と、テンプレート方式（都市ごとに一度だけ描画し、宛先だけ差し込む）で比較する。
+#
+#   python benchmarks/bench_flex_template.py
+
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from flex_template import FORECAST_MESSAGE, messages_json, push_body
+
+RECIPIENTS = int(os.environ.get("BENCH_RECIPIENTS", "10000"))
+
+FORECAST = {
+    "city_name": "東京", "date": "2026-10-16", "weather": "晴れ時々曇り",
+    "temp_max": "24", "temp_min": "15", "chance_of_rain": "0% / 10% / 20% / 10%",
+}
+
+def legacy_message_dict(city_name, date, weather, temp_max, temp_min, chance_of_rain):
+    """変更前のget_livedoor_forecast_message_dictと同じ組み立て方"""
+    return {
+        "type": "flex", "altText": f"{city_name}の天気予報",
+        "contents": {
+            "type": "bubble", "direction": 'ltr',
+            "header": {"type": "box", "layout": "vertical", "contents": [
+                {"type": "text", "text": "今日の天気予報", "weight": "bold", "size": "xl", "color": "#FFFFFF", "align": "center"}
+            ], "backgroundColor": "#00B900", "paddingTop": "12px", "paddingBottom": "12px"},
+            "body": {"type": "box", "layout": "vertical", "spacing": "md", "contents": [
+                {"type": "box", "layout": "vertical", "contents": [
+                    {"type": "text", "text": city_name, "size": "lg", "weight": "bold", "color": "#00B900"},
+                    {"type": "text", "text": date, "size": "sm", "color": "#AAAAAA"}]},
+                {"type": "separator", "margin": "md"},
+                {"type": "box", "layout": "vertical", "margin": "lg", "spacing": "sm", "contents": [
+                    {"type": "box", "layout": "baseline", "spacing": "sm", "contents": [
+                        {"type": "text", "text": "天気", "color": "#AAAAAA", "size": "sm", "flex": 2},
+                        {"type": "text", "text": weather, "wrap": True, "color": "#666666", "size": "sm", "flex": 5}]},
+                    {"type": "box", "layout": "baseline", "spacing": "sm", "contents": [
+                        {"type": "text", "text": "最高気温", "color": "#AAAAAA", "size": "sm", "flex": 2},
+                        {"type": "text", "text": f"{temp_max}°C", "wrap": True, "color": "#666666", "size": "sm", "flex": 5}]},
+                    {"type": "box", "layout": "baseline", "spacing": "sm", "contents": [
+                        {"type": "text", "text": "最低気温", "color": "#AAAAAA", "size": "sm", "flex": 2},
+                        {"type": "text", "text": f"{temp_min}°C", "wrap": True, "color": "#666666", "size": "sm", "flex": 5}]},
+                    {"type": "box", "layout": "baseline", "spacing": "sm", "contents": [
+                        {"type": "text", "text": "降水確率", "color": "#AAAAAA", "size": "sm", "flex": 2},
+                        {"type": "text", "text": chance_of_rain, "wrap": True, "color": "#666666", "size": "sm", "flex": 5}]}
+                ]}
+            ]}
+        }
+    }
+
+def legacy_bodies():
+    for i in range(RECIPIENTS):
+        body = {"to": f"U{i:032d}", "messages": [legacy_message_dict(**FORECAST)]}
+        json.dumps(body, ensure_ascii=False).encode('utf-8')
+
+def template_bodies():
+    messages = messages_json(FORECAST_MESSAGE.render(**FORECAST))
+    for i in range(RECIPIENTS):
+        push_body(f"U{i:032d}", messages)
+
+if __name__ == "__main__":
+    # 両方式で同じ内容のメッセージになることを確認してから計測する
+    assert json.loads(FORECAST_MESSAGE.render(**FORECAST)) == legacy_message_dict(**FORECAST)
+    for label, func in [("dict+dumps", legacy_bodies), ("template", template_bodies)]:
+        seconds = min(timeit.repeat(func, number=1, repeat=3))
+        print(f"{label:<11} {RECIPIENTS}件  {seconds * 1000:.1f}ms  ({seconds / RECIPIENTS * 1e6:.2f}µs/件)")
@@ -0,0 +1,92 @@
+# benchmarks/bench_startup.py
+#
+# Flaskアプリの起動から /ready が200を返すまでの時間（time-to-ready）を計測するベンチマーク。
+# 新しいPythonプロセスで app をimportし、次の条件を比較する。
+#   - cold:          スナップショットなし。上流（ローカルの代替サーバー）から地域情報を取得する
+#   - warm:          スナップショットあり
+#   - warm+down:     スナップショットあり・上流が応答しない
+#
+#   python benchmarks/bench_startup.py --weather-latency-ms 500
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.join(BENCH_DIR, "..")
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+
+from load_test import DEFAULT_AREAS, FakeUpstream, build_area_xml
+
+# 結果はアプリのログ（別スレッドからも出力される）と混ざらないよう、標準出力ではなくファイルに書く
+CHILD = r"""
+import json, sys, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+client = app.app.test_client()
+ready = None
+while client.get("/ready").status_code != 200:
+    if time.perf_counter() - started > float(sys.argv[1]):
+        break
+    time.sleep(0.005)
+else:
+    ready = time.perf_counter() - started
+with open(sys.argv[2], "w") as f:
+    json.dump({"import": imported - started, "ready": ready}, f)
+"""
+
+def run_child(env, timeout):
+    fd, result_path = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    start = time.perf_counter()
+    try:
+        subprocess.run([sys.executable, "-c", CHILD, str(timeout), result_path], cwd=ROOT_DIR, env=env,
+                       capture_output=True, text=True, check=True)
+        with open(result_path) as f:
+            result = json.load(f)
+    finally:
+        os.unlink(result_path)
+    result["process"] = time.perf_counter() - start
+    return result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--weather-latency-ms", type=float, default=300.0)
+    parser.add_argument("--timeout", type=float, default=10.0, help="readyにならない場合に打ち切る秒数")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    snapshot_path = os.path.join(workdir, "area_snapshot.json")
+    with FakeUpstream(build_area_xml(DEFAULT_AREAS), 0, args.weather_latency_ms / 1000, 0, 0) as upstream:
+        base_env = dict(os.environ,
+                        DATABASE_URL="sqlite:///" + os.path.join(workdir, "startup.db"),
+                        LINE_CHANNEL_SECRET="bench", LINE_CHANNEL_ACCESS_TOKEN="bench",
+                        WEATHER_API_BASE_URL=upstream.base_url, AREA_REFRESH_INTERVAL="0")
+        # 未使用のポートを上流に見立てると「上流が落ちている」状態になる
+        down_env = dict(base_env, WEATHER_API_BASE_URL="http://127.0.0.1:9", HTTP_MAX_RETRIES="0")
+        # coldは取得後にスナップショットが保存されるので、毎回存在しないパスを使う
+        scenarios = [
+            ("cold", lambda: dict(base_env, AREA_SNAPSHOT_PATH=tempfile.mktemp(dir=workdir, suffix=".json"))),
+            ("warm", lambda: dict(base_env, AREA_SNAPSHOT_PATH=snapshot_path)),
+            ("warm+down", lambda: dict(down_env, AREA_SNAPSHOT_PATH=snapshot_path)),
+        ]
+        # warm用のスナップショットを、上流から取得して作っておく
+        subprocess.run([sys.executable, "area_data.py"], cwd=ROOT_DIR, check=True, capture_output=True,
+                       env=dict(base_env, AREA_SNAPSHOT_PATH=snapshot_path))
+
+        for label, make_env in scenarios:
+            results = [run_child(make_env(), args.timeout) for _ in range(args.repeat)]
+            best = min(results, key=lambda r: r["ready"] if r["ready"] is not None else float("inf"))
+            ready = f"{best['ready'] * 1000:.0f}ms" if best["ready"] is not None else "not ready"
+            print(f"{label:<10} import={best['import'] * 1000:.0f}ms  time-to-ready={ready}  "
+                  f"process={best['process'] * 1000:.0f}ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+# benchmarks/bench_state_cache.py
+#
+# 地点登録ウィザード1メッセージ分のDBアクセス（状態の取得→更新）の時間を、
+# ユーザー状態キャッシュなし／ありで比較するベンチマーク。
+#
+#   DATABASE_URL=postgresql://... python benchmarks/bench_state_cache.py
+#
+# DATABASE_URLを指定しない場合は一時ディレクトリのSQLiteファイルで計測する。
+
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+if not os.environ.get("DATABASE_URL"):
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench_state_cache.db")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import database
+
+USERS = int(os.environ.get("BENCH_USERS", "200"))
+MESSAGES_PER_USER = int(os.environ.get("BENCH_MESSAGES_PER_USER", "5"))
+
+def run(label, cache):
+    """ウィザードのやりとりを再現し、1メッセージあたりのDB処理時間を計測する"""
+    database.STATE_CACHE = cache
+    states = ['waiting_for_area', 'waiting_for_pref:関東', 'waiting_for_city:東京都']
+    timings = []
+    for step in range(MESSAGES_PER_USER):
+        for i in range(USERS):
+            user_id = f"bench-{i}"
+            start = time.perf_counter()
+            database.get_user_state(user_id)
+            database.set_user_state(user_id, states[step % len(states)])
+            timings.append(time.perf_counter() - start)
+    timings.sort()
+    print(f"{label:<10} messages={len(timings):>6}  "
+          f"mean={statistics.mean(timings) * 1000:.3f}ms  "
+          f"p50={timings[len(timings) // 2] * 1000:.3f}ms  "
+          f"p99={timings[int(len(timings) * 0.99)] * 1000:.3f}ms")
+
+if __name__ == "__main__":
+    database.init_db()
+    run("no cache", database.UserStateCache(max_size=0, ttl=0))
+    run("cache", database.UserStateCache(ttl=300))
@@ -0,0 +1,352 @@
+# benchmarks/load_test.py
+#
+# 本物のLINE・天気APIに接続せずに、デイリー通知とWebhook処理の性能を計測する負荷試験。
+#
+# ローカルに以下の代替サーバーを立て、一時ディレクトリのSQLiteに合成ユーザーを登録してから計測する。
+#   - 天気API:   GET  /primary_area.xml, GET /api/forecast?city=...
+#   - LINE API:  POST /v2/bot/message/reply, /push, /multicast
+# LINE APIには遅延と429（Retry-After付き）を注入できる。
+#
+#   python benchmarks/load_test.py --users 20000 --line-latency-ms 30 --rate-429 0.01
+#   python benchmarks/load_test.py --skip-notifier --webhook-messages 5000 --webhook-async
+#
+# 都市IDは県庁所在地など実在のIDを使う。--area-xml に本物のprimary_area.xmlを渡すと、その全都市を使う。
+
+import argparse
+import base64
+import contextlib
+import hashlib
+import hmac
+import io
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+CHANNEL_SECRET = "load-test-secret"
+
+# エリア -> 都道府県 -> [(都市名, 都市ID)]
+DEFAULT_AREAS = {
+    "北海道": {"道央": [("札幌", "016010")], "道北": [("旭川", "012010")]},
+    "東北": {"青森県": [("青森", "020010")], "岩手県": [("盛岡", "030010")], "宮城県": [("仙台", "040010")],
+             "秋田県": [("秋田", "050010")], "山形県": [("山形", "060010")], "福島県": [("福島", "070010")]},
+    "関東": {"茨城県": [("水戸", "080010")], "栃木県": [("宇都宮", "090010")], "群馬県": [("前橋", "100010")],
+             "埼玉県": [("さいたま", "110010")], "千葉県": [("千葉", "120010")], "東京都": [("東京", "130010")],
+             "神奈川県": [("横浜", "140010")]},
+    "甲信": {"山梨県": [("甲府", "190010")], "長野県": [("長野", "200010")]},
+    "北陸": {"新潟県": [("新潟", "150010")], "富山県": [("富山", "160010")], "石川県": [("金沢", "170010")],
+             "福井県": [("福井", "180010")]},
+    "東海": {"岐阜県": [("岐阜", "210010")], "静岡県": [("静岡", "220010")], "愛知県": [("名古屋", "230010")],
+             "三重県": [("津", "240010")]},
+    "近畿": {"滋賀県": [("大津", "250010")], "京都府": [("京都", "260010")], "大阪府": [("大阪", "270000")],
+             "兵庫県": [("神戸", "280010")], "奈良県": [("奈良", "290010")], "和歌山県": [("和歌山", "300010")]},
+    "中国": {"鳥取県": [("鳥取", "310010")], "島根県": [("松江", "320010")], "岡山県": [("岡山", "330010")],
+             "広島県": [("広島", "340010")], "山口県": [("山口", "350020")]},
+    "四国": {"徳島県": [("徳島", "360010")], "香川県": [("高松", "370000")], "愛媛県": [("松山", "380010")],
+             "高知県": [("高知", "390010")]},
+    "九州": {"福岡県": [("福岡", "400010")], "佐賀県": [("佐賀", "410010")], "長崎県": [("長崎", "420010")],
+             "熊本県": [("熊本", "430010")], "大分県": [("大分", "440010")], "宮崎県": [("宮崎", "450010")],
+             "鹿児島県": [("鹿児島", "460010")]},
+    "沖縄": {"沖縄本島": [("那覇", "471010")]},
+}
+
+def build_area_xml(areas):
+    """エリア定義からprimary_area.xml互換のXMLを作る"""
+    root = ET.Element("rss")
+    channel = ET.SubElement(root, "channel")
+    for area_name, prefs in areas.items():
+        area = ET.SubElement(channel, "area", title=area_name)
+        for pref_name, cities in prefs.items():
+            pref = ET.SubElement(area, "pref", title=pref_name)
+            for city_name, city_id in cities:
+                ET.SubElement(pref, "city", title=city_name, id=city_id)
+    return ET.tostring(root, encoding="utf-8")
+
+def load_areas(xml_bytes):
+    """primary_area.xmlを読み、エリア定義に変換する"""
+    try:
+        root = ET.fromstring(xml_bytes.decode("euc-jp"))
+    except Exception:
+        root = ET.fromstring(xml_bytes.decode("utf-8"))
+    return {
+        area.get("title"): {
+            pref.get("title"): [(city.get("title"), city.get("id")) for city in pref.findall("city")]
+            for pref in area.findall("pref")
+        }
+        for area in root.iter("area")
+    }
+
+def percentile(sorted_values, ratio):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * ratio))]
+
+class RequestTimer:
+    """requests.Session.sendを包み、全ての外向きHTTPリクエストの所要時間を記録する"""
+
+    def __init__(self):
+        import requests
+        self._session_class = requests.Session
+        self._original_send = requests.Session.send
+        self._lock = threading.Lock()
+        self.timings = []
+
+    def __enter__(self):
+        original_send = self._original_send
+        timer = self
+
+        def timed_send(session, request, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original_send(session, request, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                with timer._lock:
+                    timer.timings.append(elapsed)
+
+        self._session_class.send = timed_send
+        return self
+
+    def __exit__(self, *exc):
+        self._session_class.send = self._original_send
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    """クライアントが途中で切断したときのエラーを表示しないHTTPサーバー"""
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            super().handle_error(request, client_address)
+
+class FakeUpstream:
+    """天気APIとLINE APIの代わりに応答するローカルHTTPサーバー"""
+
+    def __init__(self, area_xml, line_latency, weather_latency, rate_429, retry_after):
+        self.area_xml = area_xml
+        self.line_latency = line_latency
+        self.weather_latency = weather_latency
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.counts = {}
+        self._lock = threading.Lock()
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body, content_type="application/json", headers=None):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                upstream.count(f"GET {url.path}")
+                time.sleep(upstream.weather_latency)
+                if url.path == "/primary_area.xml":
+                    self._send(200, upstream.area_xml, "application/xml")
+                elif url.path == "/api/forecast":
+                    city_id = parse_qs(url.query).get("city", [""])[0]
+                    self._send(200, json.dumps(fake_forecast(city_id), ensure_ascii=False).encode("utf-8"))
+                else:
+                    self._send(404, b"{}")
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                path = urlparse(self.path).path
+                time.sleep(upstream.line_latency)
+                if random.random() < upstream.rate_429:
+                    upstream.count(f"429 {path}")
+                    self._send(429, b'{"message":"Too Many Requests"}', headers={"Retry-After": str(upstream.retry_after)})
+                    return
+                upstream.count(f"POST {path}")
+                self._send(200, b"{}")
+
+        self.server = QuietHTTPServer(("127.0.0.1", 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def count(self, key):
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+
+def fake_forecast(city_id):
+    return {"forecasts": [{
+        "date": time.strftime("%Y-%m-%d"),
+        "telop": random.choice(["晴れ", "曇り", "雨", "晴時々曇"]),
+        "temperature": {"max": {"celsius": str(random.randint(10, 30))}, "min": None},
+        "chanceOfRain": {"T00_06": "10%", "T06_12": "20%", "T12_18": "30%", "T18_24": "10%"},
+    }]}
+
+def seed_users(database, areas, count):
+    """合成ユーザーを実在の都市IDに散らばるように登録する"""
+    from sqlalchemy import text
+    cities = [(city_name, city_id) for prefs in areas.values() for cities in prefs.values() for city_name, city_id in cities]
+    # 大都市ほど人が多い分布にする
+    weights = [1.0 / (rank + 1) for rank in range(len(cities))]
+    rows = []
+    for i in range(count):
+        city_name, city_id = random.choices(cities, weights)[0]
+        rows.append({"user_id": f"U{i:032x}", "city_name": city_name, "city_id": city_id})
+    with database.engine.connect() as connection:
+        connection.execute(text("DELETE FROM users"))
+        connection.execute(text("""
+            INSERT INTO users (user_id, state, city_name, city_id) VALUES (:user_id, 'normal', :city_name, :city_id)
+        """), rows)
+        connection.commit()
+    return len({row["city_id"] for row in rows})
+
+@contextlib.contextmanager
+def measure(label, trace_memory):
+    """処理時間とメモリのピークを計測して表示する"""
+    if trace_memory:
+        tracemalloc.start()
+    result = {}
+    start = time.perf_counter()
+    yield result
+    result["wall"] = time.perf_counter() - start
+    if trace_memory:
+        result["peak_mb"] = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+        tracemalloc.stop()
+    result["maxrss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def report(label, count, unit, result, timings):
+    timings = sorted(timings)
+    memory = f"peak={result['peak_mb']:.1f}MB " if "peak_mb" in result else ""
+    print(f"[{label}] {count}{unit} in {result['wall']:.2f}s "
+          f"({count / result['wall']:.0f}{unit}/s)  "
+          f"p50={percentile(timings, 0.50) * 1000:.1f}ms p99={percentile(timings, 0.99) * 1000:.1f}ms  "
+          f"{memory}maxrss={result['maxrss_mb']:.0f}MB")
+
+def run_notifier(args, trace_memory):
+    import daily_notifier
+    with RequestTimer() as timer, measure("notifier", trace_memory) as result:
+        with contextlib.redirect_stdout(io.StringIO()):
+            summary = daily_notifier.send_daily_forecasts()
+    delivered = sum(1 for r in summary["results"] if r.ok)
+    report("notifier", delivered, " users", result, timer.timings)
+    print(f"           upstream requests={len(timer.timings)}  cache={summary['cache']}")
+    import http_client
+    print(f"           connections={http_client.stats()}")
+
+def webhook_body(user_id, event):
+    base = {"mode": "active", "timestamp": int(time.time() * 1000), "source": {"type": "user", "userId": user_id},
+            "webhookEventId": uuid.uuid4().hex, "deliveryContext": {"isRedelivery": False}, "replyToken": uuid.uuid4().hex}
+    base.update(event)
+    body = json.dumps({"destination": "Uload", "events": [base]}, ensure_ascii=False)
+    signature = base64.b64encode(hmac.new(CHANNEL_SECRET.encode(), body.encode("utf-8"), hashlib.sha256).digest()).decode()
+    return body, signature
+
+def wizard_conversation(user_id, areas):
+    """1人分の地点登録の会話（フォロー→エリア→都道府県→都市）のWebhookを作る"""
+    area_name = random.choice(list(areas))
+    pref_name = random.choice(list(areas[area_name]))
+    city_name, _ = random.choice(areas[area_name][pref_name])
+    yield webhook_body(user_id, {"type": "follow", "follow": {"isUnblocked": False}})
+    for text in (area_name, pref_name, city_name):
+        yield webhook_body(user_id, {"type": "message", "message": {"type": "text", "id": uuid.uuid4().hex, "text": text, "quoteToken": "q"}})
+
+def run_webhooks(args, areas, trace_memory):
+    import app
+    conversations = [list(wizard_conversation(f"W{i:032x}", areas)) for i in range(max(1, args.webhook_messages // 4))]
+    timings = []
+    lock = threading.Lock()
+
+    def replay(conversation):
+        client = app.app.test_client()
+        for body, signature in conversation:
+            start = time.perf_counter()
+            response = client.post("/callback", data=body, headers={"X-Line-Signature": signature, "Content-Type": "application/json"})
+            elapsed = time.perf_counter() - start
+            assert response.status_code == 200, response.status_code
+            with lock:
+                timings.append(elapsed)
+
+    with measure("webhook", trace_memory) as result:
+        with contextlib.redirect_stdout(io.StringIO()):
+            with ThreadPoolExecutor(max_workers=args.webhook_clients) as executor:
+                list(executor.map(replay, conversations))
+            if getattr(app, "EVENT_POOL", None) is not None:
+                app.EVENT_POOL.join()
+    report("webhook", len(timings), " events", result, timings)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=5000, help="登録する合成ユーザー数")
+    parser.add_argument("--webhook-messages", type=int, default=2000, help="再生するWebhookイベント数")
+    parser.add_argument("--webhook-clients", type=int, default=8, help="Webhookを同時に送るクライアント数")
+    parser.add_argument("--webhook-async", action="store_true", help="WEBHOOK_ASYNC=1 で計測する")
+    parser.add_argument("--line-latency-ms", type=float, default=20.0)
+    parser.add_argument("--weather-latency-ms", type=float, default=50.0)
+    parser.add_argument("--rate-429", type=float, default=0.0, help="LINE APIが429を返す確率")
+    parser.add_argument("--retry-after", type=int, default=1, help="429応答のRetry-After秒数")
+    parser.add_argument("--area-xml", help="本物のprimary_area.xmlのパス")
+    parser.add_argument("--skip-notifier", action="store_true")
+    parser.add_argument("--skip-webhook", action="store_true")
+    parser.add_argument("--no-tracemalloc", action="store_true", help="tracemallocによるピークメモリ計測を行わない")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    if args.area_xml:
+        with open(args.area_xml, "rb") as f:
+            area_xml = f.read()
+        areas = load_areas(area_xml)
+    else:
+        areas = DEFAULT_AREAS
+        area_xml = build_area_xml(areas)
+
+    upstream = FakeUpstream(area_xml, args.line_latency_ms / 1000, args.weather_latency_ms / 1000, args.rate_429, args.retry_after)
+    with upstream:
+        # 対象モジュールは環境変数を読み込み時に参照するので、importより前に設定する
+        workdir = tempfile.mkdtemp()
+        os.environ.update({
+            "DATABASE_URL": os.environ.get("LOAD_TEST_DATABASE_URL") or "sqlite:///" + os.path.join(workdir, "load_test.db"),
+            # 代替サーバーの地域一覧で、アプリ本来のスナップショットを上書きしないようにする
+            "AREA_SNAPSHOT_PATH": os.path.join(workdir, "area_snapshot.json"),
+            "LINE_CHANNEL_ACCESS_TOKEN": "load-test-token",
+            "LINE_CHANNEL_SECRET": CHANNEL_SECRET,
+            "LINE_API_BASE_URL": upstream.base_url,
+            "WEATHER_API_BASE_URL": upstream.base_url,
+        })
+        if args.webhook_async:
+            os.environ["WEBHOOK_ASYNC"] = "1"
+        sys.path.insert(0, ROOT_DIR)
+        import database
+        database.init_db()
+        cities = seed_users(database, areas, args.users)
+        print(f"合成ユーザー {args.users}人 / {cities}都市 を登録しました。 upstream={upstream.base_url}")
+
+        trace_memory = not args.no_tracemalloc
+        if not args.skip_notifier:
+            run_notifier(args, trace_memory)
+        if not args.skip_webhook:
+            run_webhooks(args, areas, trace_memory)
+        print(f"upstream counts: {dict(sorted(upstream.counts.items()))}")
+
+if __name__ == "__main__":
+    main()
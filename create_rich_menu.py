@@ -1,8 +1,9 @@
 import os
-import requests # requestsを直接使うのでインポートを確認
+import json
+import argparse
+import http_client # 画像のアップロードは共有のHTTPクライアントで直接行う
 from linebot.v3.messaging import (
-    Configuration, ApiClient, MessagingApi,
-    RichMenuRequest, RichMenuArea, RichMenuBounds, PostbackAction
+    Configuration, ApiClient, MessagingApi, RichMenuRequest
 )
 from dotenv import load_dotenv
 
@@ -12,76 +13,122 @@ load_dotenv()
 # 環境変数からチャネルアクセストークンを取得
 CHANNEL_ACCESS_TOKEN = os.environ.get("LINE_CHANNEL_ACCESS_TOKEN")
 
-# LINE Bot APIの初期化（リッチメニューの骨組み作成とデフォルト設定にのみ使用）
+# LINE Bot APIの初期化（リッチメニューの骨組み作成・一覧取得・デフォルト設定にのみ使用）
 configuration = Configuration(access_token=CHANNEL_ACCESS_TOKEN)
 api_client = ApiClient(configuration)
 line_bot_api = MessagingApi(api_client)
 
-# リッチメニュー用の画像ファイル名
-RICH_MENU_IMAGE_PATH = "rich_menu_image.png"
+# add_text_to_image.py が書き出す、リッチメニュー画像と定義のマニフェスト
+RICH_MENU_MANIFEST_PATH = "rich_menu_manifest.json"
+# メニュー名に埋め込む内容ハッシュの桁数（メニュー名は最大300文字）
+HASH_LENGTH = 16
 
-def create_rich_menu():
+def rich_menu_name(entry):
+    """メニューの種類と内容のハッシュから、リッチメニューの名前を作る関数"""
+    return f"{entry['name']}-{entry['sha256'][:HASH_LENGTH]}"
+
+def upload_image(rich_menu_id, image_path):
+    """リッチメニューの画像を、共有のHTTPクライアントでアップロードする関数。成功すればTrue"""
+    # LINEの仕様書に定められた、画像アップロード用のURL
+    upload_url = f"https://api-data.line.me/v2/bot/richmenu/{rich_menu_id}/content"
+    # リクエストに必要なヘッダー情報
+    headers = {
+        "Authorization": f"Bearer {CHANNEL_ACCESS_TOKEN}",
+        "Content-Type": "image/png"
+    }
+    # 画像ファイルをバイナリモードで読み込む（リトライ時に送り直せるようにbytesで持つ）
+    with open(image_path, 'rb') as f:
+        image_data = f.read()
+    response = http_client.post(upload_url, endpoint="line_richmenu_upload", headers=headers, data=image_data)
+    if response.status_code == 200:
+        return True
+    # もし失敗したら、サーバーからの応答を表示して原因を特定
+    print("エラー: 画像のアップロードに失敗しました。")
+    print(f"ステータスコード: {response.status_code}")
+    print(f"応答内容: {response.text}")
+    return False
+
+def has_image(rich_menu_id):
+    """リッチメニューに画像がアップロード済みかどうかを返す関数（404なら未アップロード）"""
+    download_url = f"https://api-data.line.me/v2/bot/richmenu/{rich_menu_id}/content"
+    headers = {"Authorization": f"Bearer {CHANNEL_ACCESS_TOKEN}"}
+    # 有無だけ分かればよいので、画像の本体は読み込まずに閉じる
+    response = http_client.get(download_url, endpoint="line_richmenu_content", headers=headers, stream=True)
+    response.close()
+    if response.status_code == 404:
+        return False
+    response.raise_for_status()
+    return True
+
+def create_rich_menu(manifest, prune=False):
+    """マニフェストの各リッチメニューを、同じ内容のものがまだなければ作成し、デフォルトを設定する関数
+
+    メニュー名には内容（画像と定義）のハッシュを埋め込んでいるので、同じ名前のメニューがあれば
+    作成とアップロードを省略する。prune=Trueなら、同じ種類の古いメニューを削除する。
+    """
     print("リッチメニューを作成します...")
-    
-    # 1. リッチメニューの構造（骨組み）を定義
-    rich_menu_to_create = RichMenuRequest(
-        size={'width': 2500, 'height': 843},
-        selected=False,
-        name="final-direct-upload-menu", # 新しい名前で作成
-        chat_bar_text="メニュー",
-        areas=[
-            RichMenuArea(
-                bounds=RichMenuBounds(x=0, y=0, width=2500, height=843),
-                action=PostbackAction(label="change_location", data="action=change_location")
-            )
-        ]
-    )
-    
     try:
-        # 2. リッチメニューの骨組みを作成し、IDを取得
-        rich_menu_id_response = line_bot_api.create_rich_menu(rich_menu_request=rich_menu_to_create)
-        rich_menu_id = rich_menu_id_response.rich_menu_id
-        print(f"リッチメニューの骨組みを作成しました。ID: {rich_menu_id}")
+        # 1. 既存のリッチメニューを名前で引けるようにする
+        existing = {menu.name: menu.rich_menu_id for menu in line_bot_api.get_rich_menu_list().richmenus}
+        menu_ids = {}
+        for entry in manifest:
+            name = rich_menu_name(entry)
+            if name in existing:
+                if has_image(existing[name]):
+                    menu_ids[entry["name"]] = existing[name]
+                    print(f"「{name}」は作成済みのため、アップロードを省略します。ID: {existing[name]}")
+                    continue
+                # 前回のアップロードが途中で止まり、画像のない骨組みだけが残っている
+                line_bot_api.delete_rich_menu(existing[name])
+                print(f"「{name}」には画像がないため、削除して作り直します。ID: {existing[name]}")
+
+            # 2. リッチメニューの骨組みを作成し、IDを取得
+            rich_menu_request = RichMenuRequest.from_dict({**entry["menu"], "name": name})
+            rich_menu_id = line_bot_api.create_rich_menu(rich_menu_request=rich_menu_request).rich_menu_id
+            print(f"リッチメニュー「{name}」の骨組みを作成しました。ID: {rich_menu_id}")
 
-        # 3. 【最終修正】requestsライブラリを直接使って画像をアップロード
-        print("画像をアップロードします... (requestsを直接使用)")
-        
-        # LINEの仕様書に定められた、画像アップロード用のURL
-        upload_url = f"https://api-data.line.me/v2/bot/richmenu/{rich_menu_id}/content"
-        
-        # リクエストに必要なヘッダー情報
-        headers = {
-            "Authorization": f"Bearer {CHANNEL_ACCESS_TOKEN}",
-            "Content-Type": "image/png"
-        }
-        
-        # 画像ファイルをバイナリモードで開く
-        with open(RICH_MENU_IMAGE_PATH, 'rb') as f:
-            # requests.postを使って、LINEのサーバーに直接画像データを送信する
-            response = requests.post(upload_url, headers=headers, data=f)
+            # 3. 画像をアップロード（失敗・例外のどちらでも骨組みを消して中断する）
+            uploaded = False
+            try:
+                uploaded = upload_image(rich_menu_id, entry["image_path"])
+            finally:
+                if not uploaded:
+                    line_bot_api.delete_rich_menu(rich_menu_id)
+                    print(f"画像をアップロードできなかったため、「{name}」の骨組みを削除しました。")
+            if not uploaded:
+                return
+            print(f"画像 '{entry['image_path']}' をアップロードしました。({entry['image_bytes'] / 1024:.0f}KB)")
+            menu_ids[entry["name"]] = rich_menu_id
 
-        # 通信が成功したかチェック
-        if response.status_code == 200:
-            print("画像をアップロードしました。")
-        else:
-            # もし失敗したら、サーバーからの応答を表示して原因を特定
-            print("エラー: 画像のアップロードに失敗しました。")
-            print(f"ステータスコード: {response.status_code}")
-            print(f"応答内容: {response.text}")
-            return # エラーがあったらここで処理を中断
+        # 4. 全てのユーザーにデフォルトのリッチメニューを設定
+        default_entry = next((entry for entry in manifest if entry.get("default")), None)
+        if default_entry:
+            line_bot_api.set_default_rich_menu(menu_ids[default_entry["name"]])
+            print(f"「{rich_menu_name(default_entry)}」をデフォルトリッチメニューとして設定しました。")
 
-        # 4. 全てのユーザーにこのリッチメニューをデフォルトとして設定
-        line_bot_api.set_default_rich_menu(rich_menu_id)
-        print("デフォルトリッチメニューとして設定しました。")
+        # 5. 同じ種類で内容が古いメニューを削除
+        if prune:
+            current = {rich_menu_name(entry) for entry in manifest}
+            # 種類の名前は完全一致で比べる（前方一致だと location が location-and-time-<hash> にも一致してしまう）
+            variants = {entry["name"] for entry in manifest}
+            for name, rich_menu_id in existing.items():
+                variant, _, digest = name.rpartition("-")
+                if name not in current and variant in variants and len(digest) == HASH_LENGTH:
+                    line_bot_api.delete_rich_menu(rich_menu_id)
+                    print(f"古いリッチメニュー「{name}」を削除しました。ID: {rich_menu_id}")
         print("\n★★★ リッチメニューの作成と設定が、全て完了しました！ ★★★")
 
     except Exception as e:
         print(f"エラーが発生しました: {e}")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="add_text_to_image.pyで作成したリッチメニューを登録します。")
+    parser.add_argument("--prune", action="store_true", help="同じ種類で内容が古いリッチメニューを削除する")
+    args = parser.parse_args()
     if not CHANNEL_ACCESS_TOKEN:
         print("エラー: .envファイルにLINE_CHANNEL_ACCESS_TOKENが設定されていません。")
-    elif not os.path.exists(RICH_MENU_IMAGE_PATH):
-        print(f"エラー: 画像ファイル '{RICH_MENU_IMAGE_PATH}' が見つかりません。")
+    elif not os.path.exists(RICH_MENU_MANIFEST_PATH):
+        print(f"エラー: マニフェスト '{RICH_MENU_MANIFEST_PATH}' が見つかりません。先に add_text_to_image.py を実行してください。")
     else:
-        create_rich_menu()
+        with open(RICH_MENU_MANIFEST_PATH, encoding="utf-8") as f:
+            create_rich_menu(json.load(f), prune=args.prune)
@@ -1,100 +1,529 @@
 import os
+import argparse
+import time
+import threading
+import uuid
 import requests
 import json
-from datetime import datetime
+from collections import OrderedDict, namedtuple
+from itertools import groupby
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone, timedelta
+from email.utils import parsedate_to_datetime
 from dotenv import load_dotenv
 import database
+import metrics
+import http_client
+from flex_template import FORECAST_MESSAGE, messages_json, push_body, multicast_body
 
 # --- 初期設定 ---
 load_dotenv()
 CHANNEL_ACCESS_TOKEN = os.environ.get("LINE_CHANNEL_ACCESS_TOKEN")
+# 接続先（負荷試験ではローカルの代替サーバーに向ける）
+LINE_API_BASE_URL = os.environ.get("LINE_API_BASE_URL", "https://api.line.me")
+WEATHER_API_BASE_URL = os.environ.get("WEATHER_API_BASE_URL", "https://weather.tsukumijima.net")
+# 天気予報キャッシュの有効期限（秒）と最大保持都市数
+FORECAST_CACHE_TTL = int(os.environ.get("FORECAST_CACHE_TTL", "3600"))
+FORECAST_CACHE_MAX_SIZE = int(os.environ.get("FORECAST_CACHE_MAX_SIZE", "256"))
+
+# 同時に送信中にしておくプッシュ数と、1秒あたりの送信上限（LINEのプッシュAPIのレート制限に合わせる）
+PUSH_CONCURRENCY = int(os.environ.get("PUSH_CONCURRENCY", "8"))
+PUSH_RATE_PER_SEC = float(os.environ.get("PUSH_RATE_PER_SEC", "1000"))
+# 429（レート制限）を受けたときの最大リトライ回数
+PUSH_MAX_RETRIES = int(os.environ.get("PUSH_MAX_RETRIES", "3"))
+# 同じ都市のユーザーにはマルチキャストでまとめて送信する（1リクエストの宛先は最大500人）
+USE_MULTICAST = os.environ.get("USE_MULTICAST", "1") != "0"
+MULTICAST_MAX_RECIPIENTS = 500
+# マルチキャストAPIのレート制限はプッシュAPIより低いので、1秒あたりの送信上限を別に持つ
+MULTICAST_RATE_PER_SEC = float(os.environ.get("MULTICAST_RATE_PER_SEC", "200"))
+# 事前取得（--prewarm）の同時取得数と、送信時にスナップショットを使ってよい経過時間（秒）
+PREWARM_CONCURRENCY = int(os.environ.get("PREWARM_CONCURRENCY", "8"))
+FORECAST_SNAPSHOT_MAX_AGE = int(os.environ.get("FORECAST_SNAPSHOT_MAX_AGE", "10800"))
+# 個別送信の配信記録は、この件数たまるか、前回の書き込みからこの秒数たつごとにまとめてDBへ書き込む
+# （マルチキャストは1回の送信がすでにまとまった件数なので、送信ごとに書き込む）
+LEDGER_FLUSH_SIZE = int(os.environ.get("LEDGER_FLUSH_SIZE", "500"))
+LEDGER_FLUSH_INTERVAL = float(os.environ.get("LEDGER_FLUSH_INTERVAL", "1.0"))
+# 常駐モード（--scheduler）の起動時に、さかのぼって送信する分数と、スナップショットを読み直す間隔（秒）
+SCHEDULER_CATCH_UP_MINUTES = int(os.environ.get("SCHEDULER_CATCH_UP_MINUTES", "60"))
+SCHEDULER_SNAPSHOT_RELOAD = int(os.environ.get("SCHEDULER_SNAPSHOT_RELOAD", "600"))
+MINUTES_PER_DAY = 24 * 60
+
+JST = timezone(timedelta(hours=9))
+
+FORECAST_ERROR_MESSAGE = {"type": "text", "text": "天気情報の取得に失敗しました。"}
+FORECAST_ERROR_MESSAGE_JSON = json.dumps(FORECAST_ERROR_MESSAGE, ensure_ascii=False).encode('utf-8')
 
 # --- 補助関数群 ---
-def get_livedoor_forecast_message_dict(city_id, city_name):
-    """指定された都市IDの天気予報を取得する関数"""
-    api_url = f"https://weather.tsukumijima.net/api/forecast?city={city_id}"
+def get_livedoor_forecast_message(city_id, city_name):
+    """指定された都市IDの天気予報を取得し、描画済みのFlex Message(JSONのbytes)を返す関数"""
+    api_url = f"{WEATHER_API_BASE_URL}/api/forecast?city={city_id}"
     try:
-        response = requests.get(api_url)
+        response = http_client.get(api_url, endpoint="weather_forecast")
         response.raise_for_status()
         data = response.json()
         today_forecast = data["forecasts"][0]
-        # city_nameはDBから取得したものを正として使う
-        weather = today_forecast["telop"]
         temp_max_obj = today_forecast["temperature"]["max"]
         temp_min_obj = today_forecast["temperature"]["min"]
-        temp_max = temp_max_obj["celsius"] if temp_max_obj else "--"
-        temp_min = temp_min_obj["celsius"] if temp_min_obj else "--"
-        chance_of_rain = " / ".join(today_forecast["chanceOfRain"].values())
-
-        flex_message = {
-            "type": "flex", "altText": f"{city_name}の天気予報",
-            "contents": {
-                "type": "bubble", "direction": 'ltr',
-                "header": {"type": "box", "layout": "vertical", "contents": [
-                    {"type": "text", "text": "今日の天気予報", "weight": "bold", "size": "xl", "color": "#FFFFFF", "align": "center"}
-                ], "backgroundColor": "#00B900", "paddingTop": "12px", "paddingBottom": "12px"},
-                "body": {"type": "box", "layout": "vertical", "spacing": "md", "contents": [
-                    {"type": "box", "layout": "vertical", "contents": [
-                        {"type": "text", "text": city_name, "size": "lg", "weight": "bold", "color": "#00B900"},
-                        {"type": "text", "text": today_forecast["date"], "size": "sm", "color": "#AAAAAA"}]},
-                    {"type": "separator", "margin": "md"},
-                    {"type": "box", "layout": "vertical", "margin": "lg", "spacing": "sm", "contents": [
-                        {"type": "box", "layout": "baseline", "spacing": "sm", "contents": [
-                            {"type": "text", "text": "天気", "color": "#AAAAAA", "size": "sm", "flex": 2},
-                            {"type": "text", "text": weather, "wrap": True, "color": "#666666", "size": "sm", "flex": 5}]},
-                        {"type": "box", "layout": "baseline", "spacing": "sm", "contents": [
-                            {"type": "text", "text": "最高気温", "color": "#AAAAAA", "size": "sm", "flex": 2},
-                            {"type": "text", "text": f"{temp_max}°C", "wrap": True, "color": "#666666", "size": "sm", "flex": 5}]},
-                        {"type": "box", "layout": "baseline", "spacing": "sm", "contents": [
-                            {"type": "text", "text": "最低気温", "color": "#AAAAAA", "size": "sm", "flex": 2},
-                            {"type": "text", "text": f"{temp_min}°C", "wrap": True, "color": "#666666", "size": "sm", "flex": 5}]},
-                        {"type": "box", "layout": "baseline", "spacing": "sm", "contents": [
-                            {"type": "text", "text": "降水確率", "color": "#AAAAAA", "size": "sm", "flex": 2},
-                            {"type": "text", "text": chance_of_rain, "wrap": True, "color": "#666666", "size": "sm", "flex": 5}]}
-                    ]}
-                ]}
-            }
-        }
-        return flex_message
+        # city_nameはDBから取得したものを正として使う
+        return FORECAST_MESSAGE.render(
+            city_name=city_name,
+            date=today_forecast["date"],
+            weather=today_forecast["telop"],
+            temp_max=temp_max_obj["celsius"] if temp_max_obj else "--",
+            temp_min=temp_min_obj["celsius"] if temp_min_obj else "--",
+            chance_of_rain=" / ".join(today_forecast["chanceOfRain"].values()),
+        )
     except Exception as e:
         print(f"Livedoor Forecast API Error: {e}")
-        return {"type": "text", "text": "天気情報の取得に失敗しました。"}
+        return FORECAST_ERROR_MESSAGE_JSON
+
+class ForecastCache:
+    """都市IDごとの天気予報メッセージを1回の実行中だけ保持するキャッシュ（TTL・上限件数付き）"""
+
+    def __init__(self, ttl=FORECAST_CACHE_TTL, max_size=FORECAST_CACHE_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict() # city_id -> (有効期限, メッセージ)
+        self.hits = 0
+        self.misses = 0
+
+    def _store(self, city_id, expires_at, message):
+        self._entries[city_id] = (expires_at, message)
+        self._entries.move_to_end(city_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def preload(self, snapshots, max_age, fetched_after=0):
+        """スナップショット {city_id: (メッセージ, 取得時刻のUNIX時間)} のうち、max_age秒以内のものを読み込む
+
+        fetched_after（UNIX時間）より前に取得したもの（前日の予報など）は読み込まない。
+        """
+        now, wall_now = time.monotonic(), time.time()
+        loaded = 0
+        for city_id, (message, fetched_at) in snapshots.items():
+            if fetched_at < fetched_after:
+                continue
+            remaining = max_age - (wall_now - fetched_at)
+            if remaining > 0:
+                self._store(city_id, now + remaining, message)
+                loaded += 1
+        return loaded
+
+    def get_or_fetch(self, city_id, city_name, recipients=1):
+        """キャッシュにあればそれを返し、なければAPIから取得して保存する（recipientsは同じメッセージを受け取る人数）"""
+        now = time.monotonic()
+        entry = self._entries.get(city_id)
+        if entry is not None and now < entry[0]:
+            self.hits += recipients
+            self._entries.move_to_end(city_id)
+            return entry[1]
+
+        # 1回の取得で残りの受信者分もまかなえるので、その分はヒットとして数える
+        self.misses += 1
+        self.hits += recipients - 1
+        message = get_livedoor_forecast_message(city_id, city_name)
+        # 取得失敗はキャッシュせず、次の利用者で再取得を試みる
+        if message is not FORECAST_ERROR_MESSAGE_JSON:
+            self._store(city_id, now + self.ttl, message)
+        return message
+
+    def stats(self):
+        """ヒット率と、節約できたAPI呼び出し回数を返す"""
+        lookups = self.hits + self.misses
+        return {
+            "lookups": lookups,
+            "upstream_calls": self.misses,
+            "hits": self.hits,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "upstream_calls_saved": self.hits,
+        }
+
+def group_users_by_city(users):
+    """都市ID順に並んだユーザーを、都市ごとに(city_id, city_name, [user_id, ...])としてまとめるジェネレーター"""
+    for city_id, rows in groupby(users, key=lambda row: row[2]):
+        rows = list(rows)
+        if not city_id:
+            for user_id, city_name, _ in rows:
+                print(f"「{city_name}」の都市IDがDBにないため、ユーザー({user_id})への送信をスキップします。")
+            continue
+        yield city_id, rows[0][1], [user_id for user_id, _, _ in rows]
+
+# ユーザー1人分の送信結果
+PushResult = namedtuple("PushResult", ["user_id", "ok", "status_code", "error"])
+
+class TokenBucket:
+    """一定レートでトークンを補充し、送信ペースを制限するトークンバケット（スレッドセーフ）"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
 
-def push_to_line(user_id, messages):
-    """requestsを使って、LINEにプッシュ通知を送信する関数"""
-    headers = {"Content-Type": "application/json; charset=UTF-8", "Authorization": f"Bearer {CHANNEL_ACCESS_TOKEN}"}
-    body = {"to": user_id, "messages": messages}
+    def acquire(self):
+        """トークンを1つ取得できるまで待つ"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+def parse_retry_after(value, default):
+    """Retry-Afterヘッダー（秒数またはHTTP日付）を待機秒数に変換する関数"""
+    if not value:
+        return default
     try:
-        response = requests.post("https://api.line.me/v2/bot/message/push", headers=headers, data=json.dumps(body, ensure_ascii=False).encode('utf-8'))
-        response.raise_for_status()
-        print(f"ユーザー({user_id})への通知が成功しました。")
-    except requests.exceptions.RequestException as e:
-        print(f"ユーザー({user_id})へのLINE通知エラー: {e}")
-        if e.response: print(f"応答内容: {e.response.text}")
-
-def send_daily_forecasts():
-    """登録ユーザー全員に天気予報を通知するメイン関数"""
-    print("デイリー通知の送信を開始します...")
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return default
+
+def _post_with_retry(url, data, rate_limiter, label, target):
+    """LINEのAPIにJSON(bytes)をPOSTし、429ならRetry-Afterに従って再送する関数。(ステータスコード, エラー)を返す
+
+    X-Line-Retry-Keyを付けて送るので、再送しても同じメッセージが重複して届くことはない。
+    """
+    headers = {
+        "Content-Type": "application/json; charset=UTF-8",
+        "Authorization": f"Bearer {CHANNEL_ACCESS_TOKEN}",
+        "X-Line-Retry-Key": str(uuid.uuid4()),
+    }
+    for attempt in range(PUSH_MAX_RETRIES + 1):
+        if rate_limiter:
+            rate_limiter.acquire()
+        try:
+            response = http_client.post(url, endpoint=target, headers=headers, data=data, idempotent=True)
+        except requests.exceptions.RequestException as e:
+            print(f"{label}へのLINE通知エラー: {e}")
+            return None, str(e)
+
+        if response.status_code == 429 and attempt < PUSH_MAX_RETRIES:
+            wait = parse_retry_after(response.headers.get("Retry-After"), default=2 ** attempt)
+            print(f"{label}への通知がレート制限されました。{wait:.1f}秒後に再送します。")
+            time.sleep(wait)
+            continue
+        if response.status_code == 409:
+            # 同じリトライキーのリクエストが既に受け付けられている（キーは毎回新しく作るので、409は再送のときだけ返る。
+            # http_clientがタイムアウトや5xxの後に同じキーで再送した場合も含む）
+            print(f"{label}への通知は受け付け済みでした。")
+            return response.status_code, None
+
+        try:
+            response.raise_for_status()
+        except requests.exceptions.HTTPError as e:
+            print(f"{label}へのLINE通知エラー: {e}")
+            print(f"応答内容: {response.text}")
+            return response.status_code, str(e)
+        print(f"{label}への通知が成功しました。")
+        return response.status_code, None
+
+def _as_messages_json(messages):
+    """メッセージのリスト、またはシリアライズ済みのJSON配列(bytes)を、bytesにそろえる関数"""
+    if isinstance(messages, bytes):
+        return messages
+    return json.dumps(messages, ensure_ascii=False).encode('utf-8')
+
+def push_to_line(user_id, messages, rate_limiter=None):
+    """requestsを使って、LINEにプッシュ通知を送信し、結果をPushResultで返す関数"""
+    body = push_body(user_id, _as_messages_json(messages))
+    status_code, error = _post_with_retry(f"{LINE_API_BASE_URL}/v2/bot/message/push", body, rate_limiter, f"ユーザー({user_id})", "line_push")
+    return PushResult(user_id, error is None, status_code, error)
+
+def multicast_to_line(user_ids, messages, rate_limiter=None, push_rate_limiter=None):
+    """同じメッセージを最大500人へまとめて送信する関数
+
+    リクエストが4xx（429を除く）で拒否された場合だけ、1人ずつのプッシュ（push_rate_limiterでレートを制限）に
+    切り替える。429や通信エラーは届いたかどうか分からない・切り替えると送信数が増えるだけなので、失敗として返す。
+    """
+    messages = _as_messages_json(messages)
+    body = multicast_body(user_ids, messages)
+    status_code, error = _post_with_retry(f"{LINE_API_BASE_URL}/v2/bot/message/multicast", body, rate_limiter, f"{len(user_ids)}人", "line_multicast")
+    if error is None or status_code is None or status_code == 429 or not 400 <= status_code < 500:
+        return [PushResult(user_id, error is None, status_code, error) for user_id in user_ids]
+    print(f"マルチキャストが拒否されたため、{len(user_ids)}人へ個別に送信します。")
+    return [push_to_line(user_id, messages, push_rate_limiter) for user_id in user_ids]
+
+def chunked(items, size):
+    """リストをsize件ずつに分割する関数"""
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+class DeliveryLedger:
+    """送信結果をためておき、flush_size件ごと・flush_interval秒ごとに配信記録へ一括で書き込む（スレッドセーフ）
+
+    途中で止まると、書き込む前の結果は'pending'のまま残り、再実行時にもう一度送られるので、ためる量は小さく保つ。
+    """
+
+    def __init__(self, run_date, flush_size=LEDGER_FLUSH_SIZE, flush_interval=LEDGER_FLUSH_INTERVAL):
+        self.run_date = run_date
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._flushed_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, results):
+        """PushResult（またはそのリスト）を記録する"""
+        if isinstance(results, PushResult):
+            results = [results]
+        with self._lock:
+            self._buffer.extend(results)
+            now = time.monotonic()
+            if len(self._buffer) < self.flush_size and now - self._flushed_at < self.flush_interval:
+                return
+            pending, self._buffer, self._flushed_at = self._buffer, [], now
+        database.record_deliveries(self.run_date, pending)
+
+    def flush(self):
+        with self._lock:
+            pending, self._buffer, self._flushed_at = self._buffer, [], time.monotonic()
+        database.record_deliveries(self.run_date, pending)
+
+def _run_concurrently(func, jobs, concurrency, rate, on_result=None):
+    """jobsの各引数でfuncを並行実行し、結果をjobsと同じ順で返す関数。on_resultは結果ごとにワーカー内で呼ばれる"""
+    rate_limiter = TokenBucket(rate) if rate > 0 else None
+    if on_result is not None:
+        original_func = func
+
+        def func(*args):
+            result = original_func(*args)
+            on_result(result)
+            return result
+
+    if concurrency <= 1:
+        return [func(*job, rate_limiter) for job in jobs]
+
+    # jobsはジェネレーターでもよい。未完了の送信数を制限し、DBの読み出しが送信より先に進みすぎないようにする
+    slots = threading.BoundedSemaphore(concurrency * 2)
+
+    def run(job):
+        try:
+            return func(*job, rate_limiter)
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = []
+        for job in jobs:
+            slots.acquire()
+            futures.append(executor.submit(run, job))
+        return [future.result() for future in futures]
+
+def deliver_pushes(jobs, concurrency=PUSH_CONCURRENCY, rate=PUSH_RATE_PER_SEC, on_result=None):
+    """(user_id, messages)のリストを、同時送信数とレートを制限しながら並行送信する関数"""
+    return _run_concurrently(push_to_line, jobs, concurrency, rate, on_result)
+
+def deliver_multicasts(jobs, concurrency=PUSH_CONCURRENCY, rate=MULTICAST_RATE_PER_SEC, push_rate=PUSH_RATE_PER_SEC, on_result=None):
+    """([user_id, ...], messages)のリストを500人ずつのマルチキャストで並行送信する関数
+
+    マルチキャストはrate、個別送信に切り替えた分はpush_rateの、それぞれ別のトークンバケットで制限する。
+    """
+    chunks = ((chunk, messages) for user_ids, messages in jobs for chunk in chunked(user_ids, MULTICAST_MAX_RECIPIENTS))
+    push_rate_limiter = TokenBucket(push_rate) if push_rate > 0 else None
+
+    def send(user_ids, messages, rate_limiter):
+        return multicast_to_line(user_ids, messages, rate_limiter, push_rate_limiter)
+
+    results = _run_concurrently(send, chunks, concurrency, rate, on_result)
+    return [result for chunk_results in results for result in chunk_results]
+
+def prewarm_forecasts(concurrency=PREWARM_CONCURRENCY):
+    """送信前に、登録ユーザーがいる全都市の天気予報を並行して取得し、スナップショットとして保存する関数"""
+    print("天気予報の事前取得を開始します...")
+    started_at = time.perf_counter()
+    database.init_db()
+    cities = database.get_registered_cities()
+
+    def fetch(city):
+        city_id, city_name = city
+        return city_id, city_name, get_livedoor_forecast_message(city_id, city_name)
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        fetched = list(executor.map(fetch, cities))
+    # 取得に失敗した都市は保存せず、送信時にその場で取得する
+    snapshots = [(city_id, city_name, message) for city_id, city_name, message in fetched if message is not FORECAST_ERROR_MESSAGE_JSON]
+    database.save_forecast_snapshots(snapshots, fetched_at=time.time())
+    print(f"天気予報の事前取得が完了しました: {len(snapshots)}/{len(cities)}都市 ({time.perf_counter() - started_at:.2f}秒)")
+    return len(snapshots), len(cities)
+
+def deliver_forecasts(run_date, users, cache):
+    """都市ID順に並んだユーザーに天気予報を送り、送信結果を配信記録に書き込む関数"""
+    # マルチキャストは1チャンク（最大500人）の結果ごとに書き込む
+    ledger = DeliveryLedger(run_date, flush_size=1) if USE_MULTICAST else DeliveryLedger(run_date)
+
+    # 同じ都市のユーザーをまとめ、天気予報の取得は都市ごとに1回だけにする
+    def city_jobs():
+        for city_id, city_name, user_ids in group_users_by_city(users):
+            print(f"登録地「{city_name}」(ID: {city_id})の天気予報を{len(user_ids)}人に送信します。")
+            forecast_message = cache.get_or_fetch(city_id, city_name, recipients=len(user_ids))
+            database.mark_deliveries_pending(run_date, user_ids)
+            # 都市ごとに一度だけ配列にし、以降は宛先を差し込むだけで送信する
+            yield user_ids, messages_json(forecast_message)
+
+    try:
+        if USE_MULTICAST:
+            return deliver_multicasts(city_jobs(), on_result=ledger.add)
+        push_jobs = ((user_id, messages) for user_ids, messages in city_jobs() for user_id in user_ids)
+        return deliver_pushes(push_jobs, on_result=ledger.add)
+    finally:
+        ledger.flush()
+
+def send_daily_forecasts(run_date=None, shard=None):
+    """登録ユーザー全員に天気予報を通知するメイン関数
+
+    run_date（'YYYY-MM-DD'、省略時は日本時間の今日）ごとに配信記録をつけ、同じ日に再実行すると
+    未送信・失敗のユーザーだけに送る。shard=(番号, 総数) を渡すと、そのシャードのユーザーだけを担当する。
+    """
+    run_date = run_date or datetime.now(JST).date().isoformat()
+    shard_text = f"（シャード {shard[0]}/{shard[1]}）" if shard else ""
+    print(f"{run_date}のデイリー通知の送信を開始します{shard_text}...")
+    started_at = time.perf_counter()
+    metrics.reset()
     database.init_db()
-    users = database.get_all_users_with_location()
-    
-    if not users:
+    # 都市ID順にページ単位で読み出し、読み込みの途中からでも送信を始める（この日に送信済みのユーザーは除く）
+    users = database.iter_users_with_location(order_by_city=True, skip_delivered_on=run_date, shard=shard)
+
+    # 事前取得したスナップショットがあればそれを使い、ない・古い都市だけその場で取得する
+    cache = ForecastCache()
+    today = datetime.now(JST).date()
+    preloaded = cache.preload(database.get_forecast_snapshots(), FORECAST_SNAPSHOT_MAX_AGE, fetched_after=start_of_day(today))
+    print(f"事前取得済みの天気予報を{preloaded}都市分読み込みました。")
+
+    results = deliver_forecasts(run_date, users, cache)
+
+    if not results:
         print("通知対象のユーザーが見つかりませんでした。")
-    
-    for user in users:
-        user_id, city_name, city_id = user # DBからcity_idを取得
-        print(f"登録地「{city_name}」(ID: {city_id})の天気予報を送信中...")
-        
-        if city_id:
-            forecast_message = get_livedoor_forecast_message_dict(city_id, city_name)
-            push_to_line(user_id, [forecast_message])
-        else:
-            print(f"「{city_name}」の都市IDがDBにないため、送信をスキップします。")
-            
+    tally = ResultTally()
+    tally.add(results)
+    print_run_summary(run_date, tally, cache, started_at)
     print("デイリー通知の送信が完了しました。")
+    return {"cache": cache.stats(), "results": results}
+
+class ResultTally:
+    """送信結果を、成功件数とステータスコード別の失敗件数に集計する（結果そのものは保持しない）"""
+
+    def __init__(self):
+        self.sent = 0
+        self.failures_by_status = {}
+
+    def add(self, results):
+        for result in results:
+            if result.ok:
+                self.sent += 1
+            else:
+                self.failures_by_status[result.status_code] = self.failures_by_status.get(result.status_code, 0) + 1
+
+    @property
+    def failed(self):
+        return sum(self.failures_by_status.values())
+
+def print_run_summary(run_date, tally, cache, started_at):
+    """1回の実行（常駐モードでは1日分）の、キャッシュのヒット率・送信結果・計測結果を表示する関数"""
+    stats = cache.stats()
+    print(f"天気予報キャッシュ: ヒット率 {stats['hit_ratio']:.1%} "
+          f"(API呼び出し {stats['upstream_calls']}回 / 節約 {stats['upstream_calls_saved']}回)")
+    print(f"送信結果: 成功 {tally.sent}件 / 失敗 {tally.failed}件")
+    if tally.failures_by_status:
+        print(f"失敗の内訳（ステータスコード別）: {tally.failures_by_status}")
+    print(f"{run_date}の配信記録: {database.get_delivery_summary(run_date)}")
+    print(f"HTTP接続の再利用状況: {http_client.stats()}")
+    print(f"実行時間: {time.perf_counter() - started_at:.2f}秒")
+    print("計測結果:\n" + metrics.format_summary())
+
+def start_of_day(day):
+    """日付の日本時間0時を、UNIX時間で返す関数"""
+    return datetime(day.year, day.month, day.day, tzinfo=JST).timestamp()
+
+def minute_of_day(moment):
+    """日時から、0時からの経過分を求める関数"""
+    return moment.hour * 60 + moment.minute
+
+def send_minute_bucket(run_date, delivery_minute, cache, shard=None):
+    """通知時刻がdelivery_minuteのユーザーだけに、天気予報を送信する関数（送信済みのユーザーは除く）"""
+    users = database.iter_users_with_location(order_by_city=True, skip_delivered_on=run_date, shard=shard,
+                                              delivery_minute=delivery_minute)
+    results = deliver_forecasts(run_date, users, cache)
+    if results:
+        failed = sum(1 for result in results if not result.ok)
+        print(f"{run_date} {delivery_minute // 60:02d}:{delivery_minute % 60:02d}の送信結果: "
+              f"成功 {len(results) - failed}件 / 失敗 {failed}件")
+    return results
+
+def run_scheduler(shard=None, catch_up_minutes=SCHEDULER_CATCH_UP_MINUTES):
+    """毎分起きて、その分が通知時刻のユーザーに天気予報を送り続ける常駐モード
+
+    起動時にはcatch_up_minutes分前からの未送信分を送る。送信が1分を超えて遅れた場合も、
+    飛ばした分は次に起きたときにまとめて送る。天気予報のキャッシュはその日のあいだ使い回し、
+    事前取得のスナップショット（その日に取得したものだけ）はSCHEDULER_SNAPSHOT_RELOAD秒ごとに読み直す。
+    日付が変わるたびに、その日の送信結果と計測結果をまとめて表示する。
+    """
+    shard_text = f"（シャード {shard[0]}/{shard[1]}）" if shard else ""
+    print(f"デイリー通知の常駐モードを開始します{shard_text}...")
+    metrics.reset()
+    database.init_db()
+    cache = None
+    now = datetime.now(JST)
+    run_date, next_minute = now.date(), max(0, minute_of_day(now) - catch_up_minutes)
+    while True:
+        now = datetime.now(JST)
+        if cache is None:
+            cache, snapshots_loaded_at = ForecastCache(), None
+            tally, started_at = ResultTally(), time.perf_counter()
+        if snapshots_loaded_at is None or time.monotonic() - snapshots_loaded_at >= SCHEDULER_SNAPSHOT_RELOAD:
+            cache.preload(database.get_forecast_snapshots(), FORECAST_SNAPSHOT_MAX_AGE, fetched_after=start_of_day(run_date))
+            snapshots_loaded_at = time.monotonic()
+        # 日付が変わっていたら、前日の残りの分を送ってから翌日に進む
+        last_minute = minute_of_day(now) if now.date() == run_date else MINUTES_PER_DAY - 1
+        while next_minute <= last_minute:
+            tally.add(send_minute_bucket(run_date.isoformat(), next_minute, cache, shard))
+            next_minute += 1
+        if now.date() != run_date:
+            print(f"{run_date.isoformat()}のデイリー通知の送信が完了しました{shard_text}。")
+            print_run_summary(run_date.isoformat(), tally, cache, started_at)
+            metrics.reset()
+            # 前日の天気予報を翌日に送らないよう、キャッシュは日ごとに作り直す
+            run_date, next_minute, cache = now.date(), 0, None
+            continue
+        # 次の分の始まりまで待つ
+        now = datetime.now(JST)
+        time.sleep(max(0.0, 60 - now.second - now.microsecond / 1_000_000))
+
+def parse_shard(value):
+    """'i/N' 形式のシャード指定を (i, N) に変換する関数（iは0始まり）"""
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("シャードは 'i/N' の形式で指定してください（例: 0/4）。")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError("シャード番号は 0 以上 N 未満で指定してください。")
+    if count > database.SHARD_BUCKETS:
+        raise argparse.ArgumentTypeError(f"シャード数は {database.SHARD_BUCKETS} 以下で指定してください。")
+    return index, count
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="登録ユーザーに今日の天気予報を通知します。")
+    parser.add_argument("--shard", type=parse_shard, help="担当するシャード（例: 0/4）。user_idのハッシュで分割する")
+    parser.add_argument("--prewarm", action="store_true", help="送信はせず、全都市の天気予報を事前取得して保存する")
+    parser.add_argument("--run-date", help="配信記録の実行日（YYYY-MM-DD）。同じ日で再実行すると未送信分だけを送る")
+    parser.add_argument("--scheduler", action="store_true", help="常駐して、毎分その分が通知時刻のユーザーに送信する")
+    args = parser.parse_args()
     if not CHANNEL_ACCESS_TOKEN:
         print("エラー: .envファイルに必要なキーが設定されていません。")
+    elif args.prewarm:
+        prewarm_forecasts()
+    elif args.scheduler:
+        try:
+            run_scheduler(shard=args.shard)
+        except KeyboardInterrupt:
+            print("デイリー通知の常駐モードを終了します。")
     else:
-        send_daily_forecasts()
+        send_daily_forecasts(run_date=args.run_date, shard=args.shard)
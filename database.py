@@ -1,5 +1,14 @@
 import os
-from sqlalchemy import create_engine, text
+import threading
+import time
+import heapq
+import zlib
+from collections import OrderedDict
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import SingletonThreadPool
+import metrics
 
 # Renderの環境変数からデータベースURLを取得
 DATABASE_URL = os.environ.get('DATABASE_URL')
@@ -8,59 +17,467 @@ DATABASE_URL = os.environ.get('DATABASE_URL')
 if DATABASE_URL and DATABASE_URL.startswith("postgres://"):
     DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql+psycopg2://", 1)
 
-engine = create_engine(DATABASE_URL) if DATABASE_URL else None
+# DATABASE_URLが未設定なら、組み込みのSQLite（1台構成・ローカルでの負荷試験用）を使う
+SQLITE_PATH = os.environ.get("SQLITE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "weather_bot.db"))
+if not DATABASE_URL:
+    DATABASE_URL = f"sqlite:///{SQLITE_PATH}"
+IS_SQLITE = make_url(DATABASE_URL).get_backend_name() == "sqlite"
 
+# コネクションプールの設定（環境変数で調整可能）
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", "10"))
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "1") != "0"
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", "1800"))
+# SQLiteの設定。接続はスレッドごとに1本持ち、上限を超えたら終了したスレッドの接続を閉じる
+SQLITE_POOL_SIZE = int(os.environ.get("SQLITE_POOL_SIZE", "32"))
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_CACHE_SIZE_KB = int(os.environ.get("SQLITE_CACHE_SIZE_KB", "20000"))
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+
+class ThreadConnectionPool(SingletonThreadPool):
+    """スレッドごとに1本の接続を持つプール
+
+    SingletonThreadPoolは接続数が上限に達すると、使用中かどうかに関係なく接続を閉じてしまう。
+    送信のたびにワーカースレッドが作り直されるので、終了したスレッドの接続だけを閉じるようにする。
+    """
+
+    def __init__(self, creator, pool_size=5, **kw):
+        super().__init__(creator, pool_size=pool_size, **kw)
+        self._owners = {} # 接続 -> 接続を作ったスレッド
+        self._owners_lock = threading.Lock()
+
+    def _do_get(self):
+        record = super()._do_get()
+        with self._owners_lock:
+            self._owners.setdefault(record, threading.current_thread())
+        return record
+
+    def _cleanup(self):
+        with self._owners_lock:
+            finished = [record for record, owner in self._owners.items() if not owner.is_alive()]
+            for record in finished:
+                del self._owners[record]
+        for record in finished:
+            self._all_conns.discard(record)
+            record.close()
+
+    def dispose(self):
+        super().dispose()
+        with self._owners_lock:
+            self._owners.clear()
+
+def _create_sqlite_engine(url):
+    """WALモードのSQLiteに、スレッドごとの接続で繋ぐエンジンを作る関数"""
+    # 接続は作ったスレッドでしか使わないが、終了したスレッドの接続は別のスレッドから閉じる
+    sqlite_engine = create_engine(url, poolclass=ThreadConnectionPool, pool_size=SQLITE_POOL_SIZE,
+                                  connect_args={"check_same_thread": False})
+
+    @event.listens_for(sqlite_engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # WALなら読み込みと書き込みが互いを待たない。同期はチェックポイント時だけにする
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        # 他の接続が書き込み中なら、エラーにせずしばらく待つ
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+        cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
+    return sqlite_engine
+
+if IS_SQLITE:
+    engine = _create_sqlite_engine(DATABASE_URL)
+else:
+    engine = create_engine(
+        DATABASE_URL,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        pool_recycle=DB_POOL_RECYCLE,
+    )
+
+# ユーザー状態キャッシュの上限件数と有効期限（秒）。どちらかが0なら無効（既定は無効）。
+# キャッシュは自プロセスの書き込みしか見えず、複数ワーカーで動かすとウィザードの状態が食い違うので、
+# 1プロセスだけで動かす場合に限って STATE_CACHE_TTL=300 などを設定して有効にすること。
+STATE_CACHE_SIZE = int(os.environ.get("STATE_CACHE_SIZE", "10000"))
+STATE_CACHE_TTL = float(os.environ.get("STATE_CACHE_TTL", "0"))
+
+_MISSING = object()
+
+class UserStateCache:
+    """ユーザーの状態を保持するLRU/TTLキャッシュ（スレッドセーフ）。書き込みはDBと同時に行う（ライトスルー）"""
+
+    def __init__(self, max_size=STATE_CACHE_SIZE, ttl=STATE_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict() # user_id -> (保存時刻, state)
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_size > 0 and self.ttl > 0
+
+    def get(self, user_id):
+        """キャッシュされた状態を返す。なければ_MISSINGを返す"""
+        if not self.enabled:
+            return _MISSING
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return _MISSING
+            if time.monotonic() - entry[0] >= self.ttl:
+                del self._entries[user_id]
+                return _MISSING
+            self._entries.move_to_end(user_id)
+            return entry[1]
+
+    def put(self, user_id, state):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[user_id] = (time.monotonic(), state)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id=None):
+        """指定ユーザー（省略時は全員）のキャッシュを破棄する"""
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+STATE_CACHE = UserStateCache()
+
+# 通知対象ユーザーを読み込むときの1ページあたりの件数
+USERS_PAGE_SIZE = int(os.environ.get("USERS_PAGE_SIZE", "1000"))
+
+# 通知時刻を設定していないユーザーは、日本時間のDEFAULT_DELIVERY_HOUR時からDELIVERY_SPREAD_MINUTES分の間に散らす
+DEFAULT_DELIVERY_HOUR = int(os.environ.get("DEFAULT_DELIVERY_HOUR", "9"))
+DELIVERY_SPREAD_MINUTES = int(os.environ.get("DELIVERY_SPREAD_MINUTES", "60"))
+# シャード分割の単位となるバケット数（シャード数はこれ以下で、約数にすると均等に分かれる）
+SHARD_BUCKETS = 64
+# 既存ユーザーに通知時刻・バケット番号を割り当てるときの1回あたりの件数
+BACKFILL_BATCH_SIZE = int(os.environ.get("BACKFILL_BATCH_SIZE", "1000"))
+
+def default_delivery_minute(user_id):
+    """通知時刻を設定していないユーザーの通知時刻（日本時間の0時からの経過分）を求める関数"""
+    # shard_ofと同じハッシュだと、シャードごとに担当する分が偏るので別の値を混ぜる
+    spread = zlib.crc32(f"delivery_minute:{user_id}".encode('utf-8')) % max(1, DELIVERY_SPREAD_MINUTES)
+    return (DEFAULT_DELIVERY_HOUR * 60 + spread) % (24 * 60)
+
+def _column_exists(connection, table, column):
+    """テーブルに列があるかどうかを、テーブルをロックせずに確認する関数"""
+    if IS_SQLITE:
+        return column in {existing["name"] for existing in inspect(connection).get_columns(table)}
+    return connection.execute(text("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = :table AND column_name = :column
+    """), {"table": table, "column": column}).first() is not None
+
+def _add_column_if_missing(connection, table, column, column_type):
+    """テーブルに列がなければ追加する関数（複数のプロセスが同時に起動しても失敗しないようにする）
+
+    ALTER TABLEはテーブル全体をロックするので、列がすでにあれば実行しない。
+    """
+    if _column_exists(connection, table, column):
+        return
+    if not IS_SQLITE:
+        # 確認してから追加するまでの間に、他のプロセスに先を越されても失敗しないようにする
+        connection.execute(text(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {column_type}"))
+        return
+    # SQLiteには ADD COLUMN IF NOT EXISTS がないので、先を越された場合のエラーは無視する
+    try:
+        connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}"))
+    except OperationalError as e:
+        if "duplicate column" not in str(e):
+            raise
+
+@metrics.timed("db_query_duration_seconds", query="init_db")
 def init_db():
     """データベースとテーブルを初期化（なければ作成）する関数"""
-    if not engine:
-        print("データベースURLが設定されていないため、初期化をスキップします。")
-        return
-    
     with engine.connect() as connection:
         connection.execute(text('''
             CREATE TABLE IF NOT EXISTS users (
                 user_id TEXT PRIMARY KEY,
                 state TEXT,
                 city_name TEXT,
-                city_id TEXT  -- 緯度経度の代わりに都市IDを保存
+                city_id TEXT,  -- 緯度経度の代わりに都市IDを保存
+                delivery_minute INTEGER,  -- 通知時刻（日本時間の0時からの経過分）
+                shard_bucket INTEGER  -- user_idのハッシュから求めたバケット番号（シャード分割に使う）
+            )
+        '''))
+        # 通知時刻・バケット番号の列がない古いテーブルには列を追加する
+        _add_column_if_missing(connection, "users", "delivery_minute", "INTEGER")
+        _add_column_if_missing(connection, "users", "shard_bucket", "INTEGER")
+        # 都市ごとにまとめて読み出すためのインデックス
+        connection.execute(text("CREATE INDEX IF NOT EXISTS idx_users_city_id_user_id ON users (city_id, user_id)"))
+        # 通知時刻ごとに、都市順で読み出すためのインデックス
+        connection.execute(text("CREATE INDEX IF NOT EXISTS idx_users_delivery_minute ON users (delivery_minute, city_id, user_id)"))
+        # シャードごとに、担当するバケットだけを都市順で読み出すためのインデックス
+        connection.execute(text("CREATE INDEX IF NOT EXISTS idx_users_shard_bucket ON users (shard_bucket, city_id, user_id)"))
+        # デイリー通知の配信記録（実行日ごと・ユーザーごと）。途中で止まった実行を再開するのに使う
+        connection.execute(text('''
+            CREATE TABLE IF NOT EXISTS deliveries (
+                run_date TEXT NOT NULL,  -- 'YYYY-MM-DD'
+                user_id TEXT NOT NULL,
+                status TEXT NOT NULL,    -- 'pending' / 'sent' / 'failed'
+                status_code INTEGER,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (run_date, user_id)
+            )
+        '''))
+        # 事前取得した都市ごとの天気予報（描画済みのFlex MessageのJSON）
+        connection.execute(text('''
+            CREATE TABLE IF NOT EXISTS forecast_snapshots (
+                city_id TEXT PRIMARY KEY,
+                city_name TEXT,
+                message TEXT NOT NULL,
+                fetched_at DOUBLE PRECISION NOT NULL  -- UNIX時間（秒）
+            )
+        '''))
+        # 適用済みのデータ移行（起動のたびに同じ移行を繰り返さないよう、完了したものを記録する）
+        connection.execute(text('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                name TEXT PRIMARY KEY,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         '''))
         connection.commit()
+    run_migration("backfill_user_columns", backfill_user_columns)
 
+def run_migration(name, migrate):
+    """nameのデータ移行がまだ完了していなければmigrateを実行し、完了を記録する関数
+
+    複数のプロセスが同時に実行しても結果が変わらない（べき等な）移行だけに使う。
+    """
+    with engine.connect() as connection:
+        applied = connection.execute(text("SELECT 1 FROM schema_migrations WHERE name = :name"), {"name": name}).first()
+    if applied is not None:
+        return False
+    migrate()
+    with engine.connect() as connection:
+        connection.execute(text("""
+            INSERT INTO schema_migrations (name) VALUES (:name) ON CONFLICT(name) DO NOTHING
+        """), {"name": name})
+        connection.commit()
+    print(f"データ移行「{name}」を適用しました。")
+    return True
+
+@metrics.timed("db_query_duration_seconds", query="backfill_user_columns")
+def backfill_user_columns(batch_size=BACKFILL_BATCH_SIZE):
+    """通知時刻・バケット番号が未設定のユーザーに、既定値をbatch_size件ずつ割り当てる関数"""
+    total = 0
+    while True:
+        with engine.connect() as connection:
+            user_ids = [row[0] for row in connection.execute(text(
+                "SELECT user_id FROM users WHERE delivery_minute IS NULL OR shard_bucket IS NULL LIMIT :limit"), {"limit": batch_size})]
+            if not user_ids:
+                break
+            connection.execute(text("""
+                UPDATE users SET
+                    delivery_minute = COALESCE(delivery_minute, :delivery_minute), shard_bucket = :shard_bucket
+                WHERE user_id = :user_id
+            """), [
+                {"user_id": user_id, "delivery_minute": default_delivery_minute(user_id), "shard_bucket": shard_bucket(user_id)}
+                for user_id in user_ids
+            ])
+            connection.commit()
+        total += len(user_ids)
+    if total:
+        print(f"{total}人のユーザーに既定の通知時刻・バケット番号を割り当てました。")
+    return total
+
+@metrics.timed("db_query_duration_seconds", query="set_user_state")
 def set_user_state(user_id, state):
     """ユーザーの状態を設定または更新する関数"""
-    if not engine: return
     with engine.connect() as connection:
         # ユーザーが存在すればstateを更新、存在しなければ新しいユーザーとしてstateと共に作成
         connection.execute(text("""
-            INSERT INTO users (user_id, state) VALUES (:user_id, :state)
+            INSERT INTO users (user_id, state, delivery_minute, shard_bucket)
+            VALUES (:user_id, :state, :delivery_minute, :shard_bucket)
             ON CONFLICT(user_id) DO UPDATE SET state = :state
-        """), {"user_id": user_id, "state": state})
+        """), {"user_id": user_id, "state": state, "delivery_minute": default_delivery_minute(user_id), "shard_bucket": shard_bucket(user_id)})
         connection.commit()
+    STATE_CACHE.put(user_id, state)
 
 def get_user_state(user_id):
-    """ユーザーの状態を取得する関数"""
-    if not engine: return None
-    with engine.connect() as connection:
+    """ユーザーの状態を取得する関数（キャッシュにあればDBに問い合わせない）"""
+    state = STATE_CACHE.get(user_id)
+    if state is not _MISSING:
+        metrics.inc("state_cache_requests_total", result="hit")
+        return state
+    metrics.inc("state_cache_requests_total", result="miss")
+    with metrics.timer("db_query_duration_seconds", query="get_user_state"), engine.connect() as connection:
         result = connection.execute(text("SELECT state FROM users WHERE user_id = :user_id"), {"user_id": user_id}).fetchone()
-        return result[0] if result else None
+    state = result[0] if result else None
+    STATE_CACHE.put(user_id, state)
+    return state
 
+def invalidate_user_state(user_id=None):
+    """ユーザー状態のキャッシュを破棄する関数（DBを直接書き換えたときなどに使う）"""
+    STATE_CACHE.invalidate(user_id)
+
+@metrics.timed("db_query_duration_seconds", query="set_user_location")
 def set_user_location(user_id, city_name, city_id):
     """ユーザーの登録地と、状態を'normal'にリセットする関数"""
-    if not engine: return
     with engine.connect() as connection:
         # 地点情報と、状態を'normal'にリセット
         connection.execute(text("""
-            INSERT INTO users (user_id, state, city_name, city_id) VALUES (:user_id, 'normal', :city_name, :city_id)
+            INSERT INTO users (user_id, state, city_name, city_id, delivery_minute, shard_bucket)
+            VALUES (:user_id, 'normal', :city_name, :city_id, :delivery_minute, :shard_bucket)
             ON CONFLICT(user_id) DO UPDATE SET 
                 state = 'normal', city_name = :city_name, city_id = :city_id
-        """), {"user_id": user_id, "city_name": city_name, "city_id": city_id})
+        """), {"user_id": user_id, "city_name": city_name, "city_id": city_id,
+               "delivery_minute": default_delivery_minute(user_id), "shard_bucket": shard_bucket(user_id)})
+        connection.commit()
+    STATE_CACHE.put(user_id, 'normal')
+
+@metrics.timed("db_query_duration_seconds", query="set_user_delivery_minute")
+def set_user_delivery_minute(user_id, delivery_minute):
+    """ユーザーの通知時刻（日本時間の0時からの経過分）を設定する関数"""
+    with engine.connect() as connection:
+        connection.execute(text("""
+            INSERT INTO users (user_id, delivery_minute, shard_bucket) VALUES (:user_id, :delivery_minute, :shard_bucket)
+            ON CONFLICT(user_id) DO UPDATE SET delivery_minute = excluded.delivery_minute
+        """), {"user_id": user_id, "delivery_minute": delivery_minute, "shard_bucket": shard_bucket(user_id)})
+        connection.commit()
+
+@metrics.timed("db_query_duration_seconds", query="get_user_delivery_minute")
+def get_user_delivery_minute(user_id):
+    """ユーザーの通知時刻（日本時間の0時からの経過分）を取得する関数。未登録ならNone"""
+    with engine.connect() as connection:
+        result = connection.execute(text("SELECT delivery_minute FROM users WHERE user_id = :user_id"), {"user_id": user_id}).fetchone()
+    return result[0] if result else None
+
+def shard_bucket(user_id):
+    """user_idのハッシュから、そのユーザーのバケット番号（0〜SHARD_BUCKETS-1）を求める関数"""
+    return zlib.crc32(user_id.encode('utf-8')) % SHARD_BUCKETS
+
+def shard_of(user_id, shard_count):
+    """user_idのハッシュから、そのユーザーを担当するシャード番号を求める関数（バケット番号をシャード数で割った余り）"""
+    return shard_bucket(user_id) % shard_count
+
+def iter_users_with_location(page_size=USERS_PAGE_SIZE, order_by_city=False, skip_delivered_on=None, shard=None,
+                             delivery_minute=None):
+    """登録地がある全ユーザーを、キーセットページングで少しずつ読み出すジェネレーター
+
+    order_by_city=Trueの場合は(city_id, user_id)順に返すので、同じ都市のユーザーが連続して届く。
+    skip_delivered_on に実行日を渡すと、その日に送信済みのユーザーを除く。
+    shard=(番号, 総数) を渡すと、shard_ofがその番号になるユーザーだけを返す。担当するバケットごとに
+    idx_users_shard_bucketで読み出して並び順を保ったまま合流させるので、他のシャードの行は読まない。
+    delivery_minute を渡すと、通知時刻がその分のユーザーだけを返す（idx_users_delivery_minuteを使う）。
+    ページごとに接続を開閉するため、読み出し中に長時間接続を占有しない。
+    """
+    conditions = ["city_id IS NOT NULL"]
+    params = {"run_date": skip_delivered_on, "delivery_minute": delivery_minute}
+    if skip_delivered_on:
+        conditions.append("""NOT EXISTS (
+            SELECT 1 FROM deliveries d
+            WHERE d.run_date = :run_date AND d.user_id = users.user_id AND d.status = 'sent')""")
+    if delivery_minute is not None:
+        conditions.append("delivery_minute = :delivery_minute")
+    if shard is None:
+        yield from _iter_user_pages(conditions, params, page_size, order_by_city)
+        return
+    buckets = [bucket for bucket in range(SHARD_BUCKETS) if bucket % shard[1] == shard[0]]
+    streams = [
+        _iter_user_pages(conditions + ["shard_bucket = :shard_bucket"], {**params, "shard_bucket": bucket}, page_size, order_by_city)
+        for bucket in buckets
+    ]
+    # 都市IDとuser_idは英数字なので、DBの並び順とPythonの比較順は一致する
+    key = (lambda row: (row[2], row[0])) if order_by_city else (lambda row: row[0])
+    yield from heapq.merge(*streams, key=key)
+
+def _iter_user_pages(conditions, params, page_size, order_by_city):
+    """conditionsに合うユーザーを、キーセットページングで1ページずつ読み出すジェネレーター"""
+    if order_by_city:
+        order_by = "city_id, user_id"
+        keyset = "(city_id, user_id) > (:last_city_id, :last_user_id)"
+    else:
+        order_by = "user_id"
+        keyset = "user_id > :last_user_id"
+    select = "SELECT user_id, city_name, city_id FROM users WHERE "
+    first_page = text(f"{select}{' AND '.join(conditions)} ORDER BY {order_by} LIMIT :limit")
+    next_page = text(f"{select}{' AND '.join(conditions + [keyset])} ORDER BY {order_by} LIMIT :limit")
+
+    query, params = first_page, {**params, "limit": page_size}
+    while True:
+        with metrics.timer("db_query_duration_seconds", query="iter_users_with_location"), engine.connect() as connection:
+            rows = connection.execute(query, params).fetchall()
+        yield from rows
+        if len(rows) < page_size:
+            return
+        last_user_id, _, last_city_id = rows[-1]
+        query = next_page
+        params = {**params, "last_user_id": last_user_id, "last_city_id": last_city_id}
+
+@metrics.timed("db_query_duration_seconds", query="mark_deliveries_pending")
+def mark_deliveries_pending(run_date, user_ids):
+    """これから送信するユーザーを、配信記録に'pending'として一括登録する関数（既存の記録は変更しない）"""
+    if not user_ids: return
+    with engine.connect() as connection:
+        connection.execute(text("""
+            INSERT INTO deliveries (run_date, user_id, status) VALUES (:run_date, :user_id, 'pending')
+            ON CONFLICT(run_date, user_id) DO NOTHING
+        """), [{"run_date": run_date, "user_id": user_id} for user_id in user_ids])
+        connection.commit()
+
+@metrics.timed("db_query_duration_seconds", query="record_deliveries")
+def record_deliveries(run_date, results):
+    """送信結果(user_id, ok, status_code)のリストを、配信記録に一括で書き込む関数"""
+    if not results: return
+    with engine.connect() as connection:
+        connection.execute(text("""
+            INSERT INTO deliveries (run_date, user_id, status, status_code, updated_at)
+            VALUES (:run_date, :user_id, :status, :status_code, CURRENT_TIMESTAMP)
+            ON CONFLICT(run_date, user_id) DO UPDATE SET
+                status = excluded.status, status_code = excluded.status_code, updated_at = excluded.updated_at
+        """), [
+            {"run_date": run_date, "user_id": user_id, "status": 'sent' if ok else 'failed', "status_code": status_code}
+            for user_id, ok, status_code, *_ in results
+        ])
+        connection.commit()
+
+@metrics.timed("db_query_duration_seconds", query="get_delivery_summary")
+def get_delivery_summary(run_date):
+    """指定した実行日の配信記録を、状態ごとの件数で返す関数"""
+    with engine.connect() as connection:
+        rows = connection.execute(text("""
+            SELECT status, COUNT(*) FROM deliveries WHERE run_date = :run_date GROUP BY status
+        """), {"run_date": run_date}).fetchall()
+    return {status: count for status, count in rows}
+
+@metrics.timed("db_query_duration_seconds", query="get_registered_cities")
+def get_registered_cities():
+    """登録ユーザーがいる都市の(city_id, city_name)の一覧を取得する関数"""
+    with engine.connect() as connection:
+        return connection.execute(text("""
+            SELECT city_id, MIN(city_name) FROM users WHERE city_id IS NOT NULL GROUP BY city_id
+        """)).fetchall()
+
+@metrics.timed("db_query_duration_seconds", query="save_forecast_snapshots")
+def save_forecast_snapshots(snapshots, fetched_at):
+    """(city_id, city_name, メッセージのbytes)のリストを、スナップショットとして一括保存する関数"""
+    if not snapshots: return
+    with engine.connect() as connection:
+        connection.execute(text("""
+            INSERT INTO forecast_snapshots (city_id, city_name, message, fetched_at)
+            VALUES (:city_id, :city_name, :message, :fetched_at)
+            ON CONFLICT(city_id) DO UPDATE SET
+                city_name = excluded.city_name, message = excluded.message, fetched_at = excluded.fetched_at
+        """), [
+            {"city_id": city_id, "city_name": city_name, "message": message.decode('utf-8'), "fetched_at": fetched_at}
+            for city_id, city_name, message in snapshots
+        ])
         connection.commit()
 
-def get_all_users_with_location():
-    """登録地がある全ユーザーの情報を取得する関数（自動通知用）"""
-    if not engine: return []
+@metrics.timed("db_query_duration_seconds", query="get_forecast_snapshots")
+def get_forecast_snapshots():
+    """保存済みのスナップショットを {city_id: (メッセージのbytes, 取得時刻)} で返す関数"""
     with engine.connect() as connection:
-        # city_nameとcity_idを返すように変更
-        result = connection.execute(text("SELECT user_id, city_name, city_id FROM users WHERE city_id IS NOT NULL")).fetchall()
-        return result
+        rows = connection.execute(text("SELECT city_id, message, fetched_at FROM forecast_snapshots")).fetchall()
+    return {city_id: (message.encode('utf-8'), fetched_at) for city_id, message, fetched_at in rows}
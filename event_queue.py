@@ -0,0 +1,102 @@
+import queue
+import threading
+import time
+import zlib
+
+_STOP = object()
+
+class EventWorkerPool:
+    """Webhookイベントを受け取り、ワーカースレッドで並行処理するプール
+
+    同じユーザーのイベントは常に同じワーカーのキューに入るので、対話の順序は保たれる。
+    キューが一杯のときは待たずに False を返す（受信側のワーカーを止めないため。
+    その場で処理すると同じユーザーの順序が崩れるので、呼び出し側では破棄して記録する）。
+    """
+
+    def __init__(self, handle_func, workers=4, queue_size=1000):
+        self.handle_func = handle_func
+        self._queues = [queue.Queue(maxsize=max(1, queue_size // workers)) for _ in range(workers)]
+        self._threads = []
+        self._lock = threading.Lock()
+        self._stats = {
+            "enqueued": 0,       # キューに入れたイベント数
+            "processed": 0,      # 処理が完了したイベント数
+            "errors": 0,         # 処理中に例外が発生したイベント数
+            "rejected": 0,       # キューが一杯で受け付けなかったイベント数
+            "max_depth": 0,      # これまでのキュー滞留数の最大値
+            "total_wait_seconds": 0.0, # キューで待たされた時間の合計
+        }
+        for index, q in enumerate(self._queues):
+            thread = threading.Thread(target=self._run, args=(q,), name=f"webhook-worker-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+    def _run(self, q):
+        while True:
+            item = q.get()
+            try:
+                if item is _STOP:
+                    return
+                enqueued_at, event = item
+                self._count("total_wait_seconds", time.monotonic() - enqueued_at)
+                try:
+                    self.handle_func(event)
+                    self._count("processed")
+                except Exception as e:
+                    self._count("errors")
+                    print(f"Webhookイベントの処理中にエラーが発生しました: {e}")
+            finally:
+                q.task_done()
+
+    def enqueue(self, key, event):
+        """イベントをキューに入れる。keyが同じイベントは同じワーカーが順番に処理する"""
+        q = self._queues[zlib.crc32(str(key).encode('utf-8')) % len(self._queues)]
+        try:
+            q.put_nowait((time.monotonic(), event))
+        except queue.Full:
+            self._count("rejected")
+            return False
+        with self._lock:
+            self._stats["enqueued"] += 1
+            self._stats["max_depth"] = max(self._stats["max_depth"], self.depth())
+        return True
+
+    def depth(self):
+        """現在キューに滞留しているイベント数"""
+        return sum(q.qsize() for q in self._queues)
+
+    def stats(self):
+        """バックプレッシャーの状況を表す統計情報を返す"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats["depth"] = self.depth()
+        stats["capacity"] = sum(q.maxsize for q in self._queues)
+        stats["workers"] = len(self._threads)
+        return stats
+
+    def join(self):
+        """キューに入っているイベントの処理がすべて終わるまで待つ"""
+        for q in self._queues:
+            q.join()
+
+    def drain(self, timeout=30.0):
+        """残っているイベントを処理し終えてからワーカーを停止する（シャットダウン時用）"""
+        deadline = time.monotonic() + timeout
+        for q in self._queues:
+            # キューが一杯でも、停止の合図を入れるために時間切れを越えて待たない
+            try:
+                q.put(_STOP, timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Full:
+                pass
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        remaining = self.depth()
+        if remaining:
+            print(f"Webhookキューの処理が時間内に終わりませんでした。未処理: {remaining}件")
+        else:
+            print("Webhookキューの処理をすべて完了しました。")
+        return remaining
@@ -0,0 +1,70 @@
+import json
+import re
+
+_PLACEHOLDER = re.compile(r"\{\{(\w+)\}\}")
+
+class JsonTemplate:
+    """文字列中の {{name}} を差し込み位置とする、JSONシリアライズ済みのテンプレート
+
+    レイアウトはコンパイル時に一度だけJSON化しておき、描画時は差し込む値を
+    JSON文字列としてエスケープして連結するだけにする。
+    """
+
+    def __init__(self, layout):
+        serialized = json.dumps(layout, ensure_ascii=False, separators=(",", ":"))
+        parts = _PLACEHOLDER.split(serialized)
+        # parts は [リテラル, 名前, リテラル, 名前, ..., リテラル] の順に並ぶ
+        self._literals = [part.encode("utf-8") for part in parts[0::2]]
+        self._names = parts[1::2]
+
+    def render(self, **values):
+        """値を差し込んだJSONをbytesで返す"""
+        chunks = [self._literals[0]]
+        for name, literal in zip(self._names, self._literals[1:]):
+            chunks.append(json.dumps(str(values[name]), ensure_ascii=False)[1:-1].encode("utf-8"))
+            chunks.append(literal)
+        return b"".join(chunks)
+
+def _detail_row(label, placeholder):
+    return {"type": "box", "layout": "baseline", "spacing": "sm", "contents": [
+        {"type": "text", "text": label, "color": "#AAAAAA", "size": "sm", "flex": 2},
+        {"type": "text", "text": placeholder, "wrap": True, "color": "#666666", "size": "sm", "flex": 5}]}
+
+# 毎朝の天気予報のFlex Message（モジュール読み込み時に一度だけコンパイルする）
+FORECAST_MESSAGE = JsonTemplate({
+    "type": "flex", "altText": "{{city_name}}の天気予報",
+    "contents": {
+        "type": "bubble", "direction": 'ltr',
+        "header": {"type": "box", "layout": "vertical", "contents": [
+            {"type": "text", "text": "今日の天気予報", "weight": "bold", "size": "xl", "color": "#FFFFFF", "align": "center"}
+        ], "backgroundColor": "#00B900", "paddingTop": "12px", "paddingBottom": "12px"},
+        "body": {"type": "box", "layout": "vertical", "spacing": "md", "contents": [
+            {"type": "box", "layout": "vertical", "contents": [
+                {"type": "text", "text": "{{city_name}}", "size": "lg", "weight": "bold", "color": "#00B900"},
+                {"type": "text", "text": "{{date}}", "size": "sm", "color": "#AAAAAA"}]},
+            {"type": "separator", "margin": "md"},
+            {"type": "box", "layout": "vertical", "margin": "lg", "spacing": "sm", "contents": [
+                _detail_row("天気", "{{weather}}"),
+                _detail_row("最高気温", "{{temp_max}}°C"),
+                _detail_row("最低気温", "{{temp_min}}°C"),
+                _detail_row("降水確率", "{{chance_of_rain}}"),
+            ]}
+        ]}
+    }
+})
+
+def messages_json(*messages):
+    """描画済みメッセージ(bytes)を、リクエストの "messages" に入れるJSON配列にする関数"""
+    return b"[" + b",".join(messages) + b"]"
+
+def push_body(user_id, messages):
+    """プッシュAPIのリクエストボディを、宛先だけ差し込んで組み立てる関数"""
+    return b'{"to":' + json.dumps(user_id).encode("utf-8") + b',"messages":' + messages + b"}"
+
+def multicast_body(user_ids, messages):
+    """マルチキャストAPIのリクエストボディを、宛先だけ差し込んで組み立てる関数"""
+    return b'{"to":' + json.dumps(list(user_ids)).encode("utf-8") + b',"messages":' + messages + b"}"
+
+def reply_body(reply_token, messages):
+    """応答APIのリクエストボディを、リプライトークンだけ差し込んで組み立てる関数"""
+    return b'{"replyToken":' + json.dumps(reply_token).encode("utf-8") + b',"messages":' + messages + b"}"
@@ -0,0 +1,115 @@
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+# 接続先ホストごとのコネクションプールの最大接続数（同時送信数以上にしておく）
+HTTP_POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", "32"))
+# 接続エラー・タイムアウト・5xxのときの最大リトライ回数と、バックオフの基準秒数
+HTTP_MAX_RETRIES = int(os.environ.get("HTTP_MAX_RETRIES", "2"))
+HTTP_BACKOFF_BASE = float(os.environ.get("HTTP_BACKOFF_BASE", "0.5"))
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+# エンドポイントごとの (接続タイムアウト, 読み取りタイムアウト) 秒
+# HTTP_TIMEOUT_<名前の大文字> に "接続,読み取り" を設定すると上書きできる（例: HTTP_TIMEOUT_LINE_PUSH=3,20）
+DEFAULT_TIMEOUTS = {
+    "weather_area": (3.05, 15),
+    "weather_forecast": (3.05, 10),
+    "line_reply": (3.05, 5),
+    "line_push": (3.05, 10),
+    "line_multicast": (3.05, 20),
+    "line_richmenu_upload": (3.05, 30),
+    "default": (3.05, 10),
+}
+
+def _timeout_for(endpoint):
+    value = os.environ.get(f"HTTP_TIMEOUT_{endpoint.upper()}")
+    if value:
+        connect, read = value.split(",")
+        return float(connect), float(read)
+    return DEFAULT_TIMEOUTS.get(endpoint, DEFAULT_TIMEOUTS["default"])
+
+_sessions = {} # "scheme://host" -> requests.Session
+_sessions_lock = threading.Lock()
+
+def get_session(url):
+    """接続先ホストごとに共有する、Keep-Alive付きのセッションを返す関数"""
+    parts = urlsplit(url)
+    origin = f"{parts.scheme}://{parts.netloc}"
+    session = _sessions.get(origin)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(origin)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_MAXSIZE)
+                session.mount(origin, adapter)
+                _sessions[origin] = session
+    return session
+
+def _backoff(attempt):
+    """指数バックオフにランダムな揺らぎを加えた待機秒数（full jitter）"""
+    return random.uniform(0, HTTP_BACKOFF_BASE * (2 ** attempt))
+
+def request(method, url, endpoint="default", idempotent=None, **kwargs):
+    """共有セッションでHTTPリクエストを送る関数
+
+    タイムアウトはエンドポイントごとの既定値を使う。接続タイムアウトはいつでも、
+    それ以外の接続エラー・読み取りタイムアウト・5xxは冪等なリクエスト（GET、または idempotent=True）の
+    ときだけ、ゆらぎ付きのバックオフでリトライする。
+    """
+    if idempotent is None:
+        idempotent = method.upper() in ("GET", "HEAD")
+    kwargs.setdefault("timeout", _timeout_for(endpoint))
+    session = get_session(url)
+    for attempt in range(HTTP_MAX_RETRIES + 1):
+        last_attempt = attempt == HTTP_MAX_RETRIES
+        try:
+            with metrics.track_http(endpoint) as record:
+                response = session.request(method, url, **kwargs)
+                record["status"] = response.status_code
+        except requests.exceptions.ConnectTimeout:
+            # 接続が確立できなかった場合はリクエストが届いていないので、POSTでもリトライしてよい
+            if last_attempt:
+                raise
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if last_attempt or not idempotent:
+                raise
+        else:
+            if response.status_code not in RETRY_STATUS_CODES or last_attempt or not idempotent:
+                return response
+        wait = _backoff(attempt)
+        print(f"{endpoint}へのリクエストを{wait:.2f}秒後にリトライします。({attempt + 1}/{HTTP_MAX_RETRIES})")
+        time.sleep(wait)
+
+def get(url, endpoint="default", **kwargs):
+    return request("GET", url, endpoint=endpoint, **kwargs)
+
+def post(url, endpoint="default", **kwargs):
+    return request("POST", url, endpoint=endpoint, **kwargs)
+
+def stats():
+    """ホストごとのリクエスト数と新規接続数（＝接続の再利用状況）を返す関数"""
+    result = {}
+    with _sessions_lock:
+        sessions = dict(_sessions)
+    for origin, session in sessions.items():
+        adapter = session.get_adapter(origin)
+        requests_count = connections = 0
+        for key in list(adapter.poolmanager.pools.keys()):
+            pool = adapter.poolmanager.pools.get(key)
+            if pool is not None:
+                requests_count += pool.num_requests
+                connections += pool.num_connections
+        result[origin] = {
+            "requests": requests_count,
+            "connections": connections,
+            "reuse_ratio": 1 - connections / requests_count if requests_count else 0.0,
+        }
+    return result
@@ -0,0 +1,153 @@
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# Prometheusの既定に合わせたヒストグラムのバケット（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HELP = {
+    "http_client_request_duration_seconds": "外部HTTPリクエストの所要時間",
+    "http_client_responses_total": "外部HTTPリクエストの応答数（ステータスコード別）",
+    "db_query_duration_seconds": "データベース処理の所要時間",
+    "state_cache_requests_total": "ユーザー状態キャッシュの参照数",
+    "webhook_message_duration_seconds": "テキストメッセージ処理の所要時間（対話の状態別）",
+    "webhook_events_total": "受信したWebhookイベント数",
+    "webhook_events_dropped_total": "非同期処理キューが一杯で破棄したWebhookイベント数",
+}
+
+_lock = threading.Lock()
+_counters = {}   # (name, labels) -> 値
+_histograms = {} # (name, labels) -> [バケットごとの件数, 合計, 件数]
+_gauges = {}     # (name, labels) -> 現在値
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def inc(name, amount=1, **labels):
+    """カウンターを加算する"""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+def set_gauge(name, value, **labels):
+    """ゲージに現在値を設定する"""
+    key = _key(name, labels)
+    with _lock:
+        _gauges[key] = value
+
+def observe(name, value, **labels):
+    """ヒストグラムに値を記録する"""
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * len(DEFAULT_BUCKETS), 0.0, 0]
+        for i, bound in enumerate(DEFAULT_BUCKETS):
+            if value <= bound:
+                histogram[0][i] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+@contextmanager
+def timer(name, **labels):
+    """withブロックの所要時間をヒストグラムに記録する"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+def timed(name, **labels):
+    """関数の所要時間をヒストグラムに記録するデコレーター"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+@contextmanager
+def track_http(target):
+    """外部HTTPリクエストの所要時間と結果を記録する。ブロック内で result["status"] にステータスコードを入れる"""
+    result = {}
+    start = time.perf_counter()
+    try:
+        yield result
+    except Exception:
+        inc("http_client_responses_total", target=target, status="error")
+        raise
+    else:
+        inc("http_client_responses_total", target=target, status=result.get("status", "unknown"))
+    finally:
+        observe("http_client_request_duration_seconds", time.perf_counter() - start, target=target)
+
+def reset():
+    """記録した値をすべて消す"""
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+        _gauges.clear()
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+def render_prometheus():
+    """記録した値をPrometheusのテキスト形式で返す"""
+    with _lock:
+        counters = sorted(_counters.items())
+        gauges = sorted(_gauges.items())
+        histograms = sorted((key, (list(b), s, c)) for key, (b, s, c) in _histograms.items())
+    lines = []
+    declared = set()
+
+    def declare(name, kind):
+        if name not in declared:
+            declared.add(name)
+            if name in HELP:
+                lines.append(f"# HELP {name} {HELP[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in counters:
+        declare(name, "counter")
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+    for (name, labels), value in gauges:
+        declare(name, "gauge")
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+    for (name, labels), (buckets, total, count) in histograms:
+        declare(name, "histogram")
+        for bound, bucket_count in zip(DEFAULT_BUCKETS, buckets):
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {bucket_count}")
+        lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {count}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+        lines.append(f"{name}_count{_format_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+def _bucket_quantile(buckets, count, ratio):
+    """バケットの件数から分位点のおおよその上限値を求める"""
+    target = count * ratio
+    for bound, bucket_count in zip(DEFAULT_BUCKETS, buckets):
+        if bucket_count >= target:
+            return f"<={bound}s"
+    return f">{DEFAULT_BUCKETS[-1]}s"
+
+def format_summary():
+    """記録した値を、実行ログ向けの読みやすい要約にする"""
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted((key, (list(b), s, c)) for key, (b, s, c) in _histograms.items())
+    lines = []
+    for (name, labels), (buckets, total, count) in histograms:
+        label_text = _format_labels(labels)
+        lines.append(f"  {name}{label_text}: 件数 {count} / 平均 {total / count * 1000:.1f}ms / "
+                     f"p50 {_bucket_quantile(buckets, count, 0.5)} / p99 {_bucket_quantile(buckets, count, 0.99)}")
+    for (name, labels), value in counters:
+        lines.append(f"  {name}{_format_labels(labels)}: {value}")
+    return "\n".join(lines)
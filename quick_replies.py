@@ -0,0 +1,68 @@
+# quick_replies.py
+#
+# 地点登録ウィザードのQuickReply付きメッセージを、地域・都市リストから一度だけ作っておくモジュール。
+# QuickReplyのボタンは最大13個なので、それを超える選択肢は「前へ／次へ」ボタン付きのページに分ける。
+
+import json
+import re
+from types import MappingProxyType
+
+QUICK_REPLY_MAX_ITEMS = 13 # LINEのQuickReplyは最大13個
+QUICK_REPLY_PAGE_SIZE = 11 # ページに分けるときの1ページの選択肢数（残り2つは前へ／次へ）
+LABEL_MAX_LENGTH = 20      # ボタンのラベルは最大20文字
+
+PROMPTS = {
+    "area": "お住まいのエリアを選択してください。",
+    "pref": "次に都道府県を選択してください。",
+    "city": "最後に都市名を選択してください。",
+}
+
+# ページ移動ボタンのテキスト（例: "次へ ▶ (2/3)"）から、移動先のページ番号を取り出す
+_PAGE_BUTTON = re.compile(r"^(?:◀ 前へ|次へ ▶) \((\d+)/(\d+)\)$")
+
+def _button(label, text):
+    return {"type": "action", "action": {"type": "message", "label": label[:LABEL_MAX_LENGTH], "text": text}}
+
+def _page_button(label, page, page_count):
+    text = f"{label} ({page}/{page_count})"
+    return _button(text, text)
+
+def paginate(options):
+    """選択肢をQuickReplyに収まるページに分ける関数"""
+    options = list(options)
+    if len(options) <= QUICK_REPLY_MAX_ITEMS:
+        return [options]
+    return [options[i:i + QUICK_REPLY_PAGE_SIZE] for i in range(0, len(options), QUICK_REPLY_PAGE_SIZE)]
+
+def render_page(kind, pages, index):
+    """1ページ分のQuickReply付きテキストメッセージを、JSON(bytes)にする関数"""
+    page_count = len(pages)
+    items = [_button(option, option) for option in pages[index]]
+    text = PROMPTS[kind]
+    if page_count > 1:
+        text += f"（{index + 1}/{page_count}ページ）"
+        if index > 0:
+            items.insert(0, _page_button("◀ 前へ", index, page_count))
+        if index < page_count - 1:
+            items.append(_page_button("次へ ▶", index + 2, page_count))
+    message = {"type": "text", "text": text, "quickReply": {"items": items}}
+    return json.dumps(message, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def build_quick_reply_cache(index):
+    """AreaIndexから、ウィザードの各ステップ・各ページのメッセージを作る関数
+
+    キーは ("area", None) / ("pref", エリア名) / ("city", 都道府県名)、値はページごとのJSON(bytes)のタプル。
+    """
+    nodes = {("area", None): index.area_names}
+    nodes.update({("pref", area_name): prefs for area_name, prefs in index.prefs_by_area.items()})
+    nodes.update({("city", pref_name): cities for pref_name, cities in index.cities_by_pref.items()})
+    cache = {}
+    for (kind, name), options in nodes.items():
+        pages = paginate(options)
+        cache[(kind, name)] = tuple(render_page(kind, pages, i) for i in range(len(pages)))
+    return MappingProxyType(cache)
+
+def requested_page(text):
+    """ページ移動ボタンのテキストなら移動先のページ番号（1始まり）を、そうでなければNoneを返す関数"""
+    match = _PAGE_BUTTON.match(text)
+    return int(match.group(1)) if match else None